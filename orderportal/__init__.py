@@ -18,6 +18,18 @@ settings = dict(
     LOGGING_FILEMODE=None,
     DATABASE_SERVER='http://localhost:5984/',
     DATABASE_NAME='orderportal',
+    DATABASE_POOL_SIZE=10,
+    DATABASE_TIMEOUT=None,
+    DATABASE_CHANGES_INTERVAL=5,
+    CACHE_MARKDOWN_SIZE=1000,
+    CACHE_TEXT_SIZE=100,
+    CACHE_ACCOUNT_SIZE=1000,
+    CACHE_ACCOUNT_TTL=10,
+    CACHE_FORM_SIZE=100,
+    EXPORT_BATCH_SIZE=500,
+    COUNTER_BLOCK_SIZE=1,
+    LOG_BATCH_SIZE=100,
+    LOG_FLUSH_INTERVAL=1.0,
     MARKDOWN_URL='http://agea.github.io/tutorial.md/',
     SITE_DIR='{ROOT_DIR}/site',
     SITE_NAME='OrderPortal',
@@ -32,6 +44,10 @@ settings = dict(
     SITE_HOST_TITLE=None,
     EMAIL=None,                 # Must be defined for things to work.
     MESSAGE_SENDER_EMAIL='"OrderPortal Support" <support@my-domain.com>',
+    MESSAGE_QUEUE_INTERVAL=5,
+    MESSAGE_QUEUE_BATCH_SIZE=50,
+    MESSAGE_MAX_ATTEMPTS=5,
+    MESSAGE_RETRY_DELAY=60,
     DISPLAY_MENU_LIGHT=False,
     DISPLAY_MENU_ITEM_URL=None,
     DISPLAY_MENU_ITEM_TEXT=None,
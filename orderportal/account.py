@@ -10,14 +10,15 @@ from io import StringIO
 import tornado.web
 
 import orderportal
+from orderportal import cache
 from orderportal import constants
 from orderportal import saver
 from orderportal import settings
 from orderportal import utils
-from orderportal.order import OrderApiV1Mixin
+from orderportal.order import OrderApiV1Mixin, OrderJson
 from orderportal.group import GroupSaver
 from orderportal.message import MessageSaver
-from orderportal.requesthandler import RequestHandler
+from orderportal.requesthandler import RequestHandler, ApiV1Mixin
 
 
 class AccountSaver(saver.Saver):
@@ -58,6 +59,14 @@ class AccountSaver(saver.Saver):
         if not self['university']:
             raise ValueError('University is required.')
 
+    def post_process(self):
+        """Status, role, password or API key may have changed;
+        the cached account must not be used for authentication.
+        The name may have changed."""
+        cache.discard_account(self.doc['_id'])
+        cache.discard_account_name(self.doc['email'])
+        cache.update_account_role(self.doc)
+
 
 class Accounts(RequestHandler):
     "Accounts list page."
@@ -92,17 +101,47 @@ class Accounts(RequestHandler):
         if accounts is None:
             view = self.db.view('account/email', include_docs=True)
             accounts = [r.doc for r in view]
+        self.set_order_counts(accounts, self.get_order_counts())
+        return accounts
+
+    def get_accounts_batches(self):
+        """Generator of lists of accounts according to current filter.
+        When no filter, only EXPORT_BATCH_SIZE accounts at a time
+        are fetched."""
+        if self.filter:
+            yield self.get_accounts()
+            return
+        size = max(settings['EXPORT_BATCH_SIZE'], 1)
+        counts = self.get_order_counts()
+        startkey = None
+        while True:
+            kwargs = dict(include_docs=True, limit=size+1)
+            if startkey is not None:
+                kwargs['startkey'] = startkey
+            accounts = [r.doc for r in self.db.view('account/email', **kwargs)]
+            if len(accounts) > size:
+                startkey = accounts.pop()['email']
+            else:
+                startkey = None
+            self.set_order_counts(accounts, counts)
+            yield accounts
+            if startkey is None: break
+
+    def get_order_counts(self):
+        "Return a lookup of the number of orders for each account email."
         # This is optimized for retrieval speed. The single-valued
         # function 'get_account_order_count' is not good enough here.
         view = self.db.view('order/owner',
                             group_level=1,
                             startkey=[''],
                             endkey=[constants.CEILING])
-        counts = dict([(r.key[0], r.value) for r in view])
+        return dict([(r.key[0], r.value) for r in view])
+
+    def set_order_counts(self, accounts, counts):
+        "Set the order count and the name of the accounts."
         for account in accounts:
             account['order_count'] = counts.get(account['email'], 0)
             account['name'] = utils.get_account_name(account=account)
-        return accounts
 
     def filter_by_university(self, university, accounts=None):
         "Return accounts list if any university filter, or None if none."
@@ -148,64 +187,77 @@ class Accounts(RequestHandler):
         return accounts
 
 
-class AccountsApiV1(Accounts):
-    "Accounts API; JSON output."
+class AccountsApiV1(ApiV1Mixin, Accounts):
+    """Accounts API; JSON output.
+    Streamed as newline-delimited JSON if requested, one account per line
+    after the first; the accounts are then fetched and written in batches."""
 
-    def get(self):
+    async def get(self):
         "JSON output."
         URL = self.absolute_reverse_url
         self.check_staff()
         self.set_filter()
-        accounts = self.get_accounts()
         data = utils.get_json(URL('accounts_api', **self.filter), 'accounts')
         data['filter'] = self.filter
         data['links'] = dict(api=dict(href=URL('accounts_api')),
                              display=dict(href=URL('accounts')))
-        data['items'] = []
-        for account in accounts:
-            item = OD()
-            item['email'] = account['email']
-            item['links'] = dict(
-                api=dict(href=URL('account_api',account['email'])),
-                display=dict(href=URL('account',account['email'])))
-            name = last_name = account.get('last_name')
-            first_name = account.get('first_name')
-            if name:
-                if first_name:
-                    name += ', ' + first_name
-            else:
-                name = first_name
-            item['name'] = name
-            item['first_name'] = first_name
-            item['last_name'] = last_name
-            item['pi'] = bool(account.get('pi'))
-            item['gender'] = account.get('gender')
-            item['university'] = account.get('university')
-            item['role'] = account['role']
-            item['status'] = account['status']
-            item['address'] = account.get('address') or {}
-            item['invoice_ref'] = account.get('invoice_ref')
-            item['invoice_address'] = account.get('invoice_address') or {}
-            item['login'] = account.get('login', '-')
-            item['modified'] = account['modified']
-            item['orders'] = dict(
-                count=account['order_count'],
-                links=dict(
-                    display=dict(href=URL('account_orders', account['email'])),
-                    api=dict(href=URL('account_orders_api', account['email']))))
-            data['items'].append(item)
+        if self.is_stream():
+            self.write_stream_start(data)
+            for accounts in self.get_accounts_batches():
+                for account in accounts:
+                    self.write_stream_item(self.get_account_json(account))
+                await self.flush()
+            return
+        data['items'] = [self.get_account_json(a) for a in self.get_accounts()]
         self.write(data)
 
+    def get_account_json(self, account):
+        "Return the dictionary for JSON output for the account."
+        URL = self.absolute_reverse_url
+        item = OD()
+        item['email'] = account['email']
+        item['links'] = dict(
+            api=dict(href=URL('account_api',account['email'])),
+            display=dict(href=URL('account',account['email'])))
+        name = last_name = account.get('last_name')
+        first_name = account.get('first_name')
+        if name:
+            if first_name:
+                name += ', ' + first_name
+        else:
+            name = first_name
+        item['name'] = name
+        item['first_name'] = first_name
+        item['last_name'] = last_name
+        item['pi'] = bool(account.get('pi'))
+        item['gender'] = account.get('gender')
+        item['university'] = account.get('university')
+        item['role'] = account['role']
+        item['status'] = account['status']
+        item['address'] = account.get('address') or {}
+        item['invoice_ref'] = account.get('invoice_ref')
+        item['invoice_address'] = account.get('invoice_address') or {}
+        item['login'] = account.get('login', '-')
+        item['modified'] = account['modified']
+        item['orders'] = dict(
+            count=account['order_count'],
+            links=dict(
+                display=dict(href=URL('account_orders', account['email'])),
+                api=dict(href=URL('account_orders_api', account['email']))))
+        return item
+
 
 class AccountsCsv(Accounts):
-    "Return a CSV file containing all data for a set of accounts."
+    """Return a CSV file containing all data for a set of accounts.
+    The accounts are fetched in batches, and the output is written
+    to the client as it is produced."""
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         "CSV file output."
         self.check_staff()
         self.set_filter()
-        accounts = self.get_accounts()
+        self.write_start()
         writer = self.get_writer()
         writer.writerow((settings['SITE_NAME'], utils.today()))
         writer.writerow(('Email', 'Last name', 'First name', 'Role',
@@ -215,49 +267,54 @@ class AccountsCsv(Accounts):
                          'Invoice ref', 'Invoice address', 'Invoice zip',
                          'Invoice city', 'Invoice country', 'Phone',
                          'Other data', 'Latest login', 'Modified', 'Created'))
-        for account in accounts:
-            addr = account.get('address') or dict()
-            iaddr = account.get('invoice_address') or dict()
-            try:
-                subject = "{0}: {1}".format(
-                    account.get('subject'),
-                    settings['subjects_lookup'][account.get('subject')])
-            except KeyError:
-                subject = ''
-            row = [account['email'],
-                   account.get('last_name') or '',
-                   account.get('first_name') or '',
-                   account['role'],
-                   account['status'],
-                   account['order_count'],
-                   account.get('university') or '',
-                   account.get('department') or '',
-                   account.get('pi') and 'yes' or 'no',
-                   account.get('gender') or '',
-                   account.get('group_size') or '',
-                   subject,
-                   addr.get('address') or '',
-                   addr.get('zip') or '',
-                   addr.get('city') or '',
-                   addr.get('country') or '',
-                   account.get('invoice_ref') or '',
-                   iaddr.get('address') or '',
-                   iaddr.get('zip') or '',
-                   iaddr.get('city') or '',
-                   iaddr.get('country') or '',
-                   account.get('phone') or '',
-                   account.get('other_data') or '',
-                   account.get('login') or '',
-                   account.get('modified') or '',
-                   account.get('created') or '']
-            writer.writerow(row)
-        self.write(writer.getvalue())
-        self.write_finish()
+        for accounts in self.get_accounts_batches():
+            for account in accounts:
+                self.write_account(writer, account)
+            await self.write_writer(writer)
+        await self.write_writer(writer, close=True)
+
+    def write_account(self, writer, account):
+        "Write the row for the account."
+        addr = account.get('address') or dict()
+        iaddr = account.get('invoice_address') or dict()
+        try:
+            subject = "{0}: {1}".format(
+                account.get('subject'),
+                settings['subjects_lookup'][account.get('subject')])
+        except KeyError:
+            subject = ''
+        row = [account['email'],
+               account.get('last_name') or '',
+               account.get('first_name') or '',
+               account['role'],
+               account['status'],
+               account['order_count'],
+               account.get('university') or '',
+               account.get('department') or '',
+               account.get('pi') and 'yes' or 'no',
+               account.get('gender') or '',
+               account.get('group_size') or '',
+               subject,
+               addr.get('address') or '',
+               addr.get('zip') or '',
+               addr.get('city') or '',
+               addr.get('country') or '',
+               account.get('invoice_ref') or '',
+               iaddr.get('address') or '',
+               iaddr.get('zip') or '',
+               iaddr.get('city') or '',
+               iaddr.get('country') or '',
+               account.get('phone') or '',
+               account.get('other_data') or '',
+               account.get('login') or '',
+               account.get('modified') or '',
+               account.get('created') or '']
+        writer.writerow(row)
 
     def get_writer(self):
         return utils.CsvWriter()
 
-    def write_finish(self):
+    def write_start(self):
         self.set_header('Content-Type', constants.CSV_MIME)
         self.set_header('Content-Disposition', 
                         'attachment; filename="accounts.csv"')
@@ -267,9 +324,9 @@ class AccountsXlsx(AccountsCsv):
     "Return an XLSX file containing all data for a set of accounts."
 
     def get_writer(self):
-        return utils.XlsxWriter()
+        return utils.XlsxWriter(constant_memory=True)
 
-    def write_finish(self):
+    def write_start(self):
         self.set_header('Content-Type', constants.XLSX_MIME)
         self.set_header('Content-Disposition', 
                         'attachment; filename="accounts.xlsx"')
@@ -306,7 +363,7 @@ class Account(AccountMixin, RequestHandler):
     "Account page."
 
     @tornado.web.authenticated
-    def get(self, email):
+    async def get(self, email):
         try:
             account = self.get_account(email)
             self.check_readable(account)
@@ -314,6 +371,7 @@ class Account(AccountMixin, RequestHandler):
             self.see_other('home', error=str(msg))
             return
         account['order_count'] = self.get_account_order_count(account['email'])
+        utils.flush_log()       # Include the buffered entries.
         view = self.db.view('log/account',
                             startkey=[account['email'], constants.CEILING],
                             lastkey=[account['email']],
@@ -326,7 +384,7 @@ class Account(AccountMixin, RequestHandler):
         except IndexError:
             latest_activity = None
         if self.is_staff() or self.current_user['email'] == account['email']:
-            invitations = self.get_invitations(account['email'])
+            invitations = await self.get_invitations(account['email'])
         else:
             invitations = []
         self.render('account.html',
@@ -361,6 +419,7 @@ class Account(AccountMixin, RequestHandler):
             group = row.doc
             self.delete_logs(group['_id'])
             self.db.delete(group)
+        cache.reset_groups_graph()
         # Remove this account from groups it is a member of.
         view = self.db.view('group/owner',
                             include_docs=True,
@@ -385,6 +444,9 @@ class Account(AccountMixin, RequestHandler):
         self.delete_logs(account['_id'])
         # Delete the account itself.
         self.db.delete(account)
+        cache.discard_account(account['_id'])
+        cache.discard_account_name(account['email'])
+        cache.reset_account_roles()
         self.see_other('accounts')
 
     def is_deletable(self, account):
@@ -434,6 +496,7 @@ class AccountApiV1(AccountMixin, RequestHandler):
         data['invoice_address'] = account.get('invoice_address') or {}
         data['login'] = account.get('login', '-')
         data['modified'] = account['modified']
+        utils.flush_log()       # Include the buffered entries.
         view = self.db.view('log/account',
                             startkey=[account['email'], constants.CEILING],
                             lastkey=[account['email']],
@@ -477,12 +540,47 @@ class AccountOrdersMixin(object):
             orders.extend([r.doc for r in view])
         return orders
 
+    async def get_owner_orders_batches(self, email):
+        """Asynchronous generator of lists of the orders owned by the
+        account, in order of modification. Only EXPORT_BATCH_SIZE
+        orders at a time are fetched."""
+        size = max(settings['EXPORT_BATCH_SIZE'], 1)
+        kwargs = dict(reduce=False,
+                      include_docs=True,
+                      limit=size+1,
+                      startkey=[email],
+                      endkey=[email, constants.CEILING])
+        while True:
+            view = await self.async_db.view('order/owner', **kwargs)
+            if len(view) > size:
+                last = view.pop()
+                kwargs['startkey'] = last.key
+                kwargs['startkey_docid'] = last.id
+            else:
+                last = None
+            yield [r.doc for r in view]
+            if last is None: break
+
+    async def write_orders_stream(self, data, emails):
+        """Write the header and then the orders owned by the accounts
+        as newline-delimited JSON, one order per line, in batches."""
+        self.write_stream_start(data)
+        forms = self.get_forms_titles(all=True)
+        for email in emails:
+            async for orders in self.get_owner_orders_batches(email):
+                names = self.get_account_names(
+                    set([o['owner'] for o in orders]))
+                serializer = OrderJson(self, names=names, forms=forms)
+                for order in orders:
+                    self.write_stream_item(serializer(order))
+                await self.flush()
+
 
 class AccountOrders(AccountOrdersMixin, RequestHandler):
     "Page for a list of all orders for an account."
 
     @tornado.web.authenticated
-    def get(self, email):
+    async def get(self, email):
         try:
             account = self.get_account(email)
             self.check_readable(account)
@@ -495,28 +593,29 @@ class AccountOrders(AccountOrdersMixin, RequestHandler):
             order_column = 3
         order_column += len(settings['ORDERS_LIST_STATUSES']) + \
             len(settings['ORDERS_LIST_FIELDS'])
-        view = self.db.view('order/owner',
-                            reduce=False,
-                            include_docs=True,
-                            startkey=[account['email']],
-                            endkey=[account['email'], constants.CEILING])
-        orders = [r.doc for r in view]
+        view = await self.async_db.view('order/owner',
+                                        reduce=False,
+                                        startkey=[account['email']],
+                                        endkey=[account['email'],
+                                                constants.CEILING])
+        orders = [r.value for r in view]
         self.render('account_orders.html',
                     all_forms=self.get_forms_titles(all=True),
                     form_titles=sorted(self.get_forms_titles().values()),
                     orders=orders,
                     account=account,
                     order_column=order_column,
-                    account_names=self.get_account_names(),
+                    account_names=self.get_account_names([account['email']]),
                     any_groups=bool(self.get_account_groups(account['email'])))
 
 
 class AccountOrdersApiV1(AccountOrdersMixin,
                          OrderApiV1Mixin,
                          RequestHandler):
-    "Account orders API; JSON output."
+    """Account orders API; JSON output.
+    Streamed as newline-delimited JSON if requested."""
 
-    def get(self, email):
+    async def get(self, email):
         "JSON output."
         URL = self.absolute_reverse_url
         try:
@@ -527,21 +626,24 @@ class AccountOrdersApiV1(AccountOrdersMixin,
             self.check_readable(account)
         except ValueError as msg:
             raise tornado.web.HTTPError(403, reason=str(msg))
-        # Get names and forms lookups
-        names = self.get_account_names()
-        forms = self.get_forms_titles(all=True)
         data = utils.get_json(URL('account_orders', account['email']),
                               'account orders')
         data['links'] = dict(
             api=dict(href=URL('account_orders_api', account['email'])),
             display=dict(href=URL('account_orders', account['email'])))
+        if self.is_stream():
+            await self.write_orders_stream(data, [account['email']])
+            return
+        # Get names and forms lookups
+        names = self.get_account_names([account['email']])
+        forms = self.get_forms_titles(all=True)
         view = self.db.view('order/owner',
                             reduce=False,
                             include_docs=True,
                             startkey=[account['email']],
                             endkey=[account['email'], constants.CEILING])
-        data['orders'] = [self.get_order_json(r.doc, names, forms)
-                          for r in view]
+        serializer = OrderJson(self, names=names, forms=forms)
+        data['orders'] = [serializer(r.doc) for r in view]
         self.write(data)
 
 
@@ -572,9 +674,10 @@ class AccountGroupsOrders(AccountOrdersMixin, RequestHandler):
 class AccountGroupsOrdersApiV1(AccountOrdersMixin, 
                                OrderApiV1Mixin,
                                RequestHandler):
-    "Account group orders API; JSON output."
+    """Account group orders API; JSON output.
+    Streamed as newline-delimited JSON if requested."""
 
-    def get(self, email):
+    async def get(self, email):
         "JSON output."
         URL = self.absolute_reverse_url
         try:
@@ -585,16 +688,21 @@ class AccountGroupsOrdersApiV1(AccountOrdersMixin,
             self.check_readable(account)
         except ValueError as msg:
             raise tornado.web.HTTPError(403, reason=str(msg))
-        # Get names and forms lookups
-        names = self.get_account_names()
-        forms = self.get_forms_titles(all=True)
         data =utils.get_json(URL('account_groups_orders_api',account['email']),
                              'account groups orders')
         data['links'] = dict(
             api=dict(href=URL('account_groups_orders_api', account['email'])),
             display=dict(href=URL('account_groups_orders', account['email'])))
-        data['orders'] = [self.get_order_json(o, names, forms)
-                          for o in self.get_group_orders(account)]
+        if self.is_stream():
+            await self.write_orders_stream(
+                data, self.get_account_colleagues(account['email']))
+            return
+        orders = self.get_group_orders(account)
+        # Get names and forms lookups
+        names = self.get_account_names(set([o['owner'] for o in orders]))
+        forms = self.get_forms_titles(all=True)
+        serializer = OrderJson(self, names=names, forms=forms)
+        data['orders'] = [serializer(o) for o in orders]
         self.write(data)
 
 
@@ -744,7 +852,8 @@ class Login(RequestHandler):
             return
         if utils.hashed_password(password) != account.get('password'):
             utils.log(self.db, self, account,
-                      changed=dict(login_failure=account['email']))
+                      changed=dict(login_failure=account['email']),
+                      flush=True)
             view = self.db.view('log/login_failure',
                                 startkey=[account['_id'], utils.timestamp(-1)],
                                 endkey=[account['_id'], utils.timestamp()])
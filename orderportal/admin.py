@@ -5,9 +5,11 @@
 import logging
 import re
 
+import couchdb
 import tornado.web
 
 import orderportal
+from orderportal import cache
 from orderportal import constants
 from orderportal import saver
 from orderportal import settings
@@ -36,7 +38,16 @@ class GlobalModes(RequestHandler):
             if '_id' not in self.global_modes:
                 self.global_modes['_id'] = 'global_modes'
                 self.global_modes[constants.DOCTYPE] = constants.META
-            self.db.save(self.global_modes)
+            try:
+                self.db.save(self.global_modes)
+            except couchdb.ResourceConflict:
+                # Changed by another server process; not yet seen here.
+                cache.reset_global_modes()
+                self.see_other('global_modes',
+                               error='Global modes were changed elsewhere;'
+                               ' please try again.')
+                return
+            cache.set_global_modes(self.global_modes)
         self.see_other('global_modes')
 
 
@@ -58,6 +69,14 @@ class Settings(RequestHandler):
                   'BASE_URL', 'BASE_URL_PATH_PREFIX',
                   'SITE_NAME', 'SITE_SUPPORT_EMAIL',
                   'DATABASE_SERVER', 'DATABASE_NAME', 'DATABASE_ACCOUNT',
+                  'DATABASE_POOL_SIZE', 'DATABASE_TIMEOUT',
+                  'DATABASE_CHANGES_INTERVAL',
+                  'CACHE_MARKDOWN_SIZE', 'CACHE_TEXT_SIZE',
+                  'CACHE_ACCOUNT_SIZE', 'CACHE_ACCOUNT_TTL', 'CACHE_FORM_SIZE',
+                  'EXPORT_BATCH_SIZE', 'COUNTER_BLOCK_SIZE',
+                  'LOG_BATCH_SIZE', 'LOG_FLUSH_INTERVAL',
+                  'MESSAGE_QUEUE_INTERVAL', 'MESSAGE_QUEUE_BATCH_SIZE',
+                  'MESSAGE_MAX_ATTEMPTS', 'MESSAGE_RETRY_DELAY',
                   'TORNADO_DEBUG', 'LOGGING_FILEPATH', 'LOGGING_DEBUG',
                   'BACKUP_DIR', 'LOGIN_MAX_AGE_DAYS', 'LOGIN_MAX_FAILURES',
                   'SITE_DIR', 'ACCOUNT_MESSAGES_FILEPATH',
@@ -67,12 +86,21 @@ class Settings(RequestHandler):
                   'ORDERS_LIST_STATUSES', 'ORDER_AUTOPOPULATE',
                   'UNIVERSITIES_FILEPATH', 'COUNTRY_CODES_FILEPATH',
                   'SUBJECT_TERMS_FILEPATH']
-        self.render('settings.html', params=params, settings=mod_settings)
+        self.render('settings.html',
+                    params=params,
+                    settings=mod_settings,
+                    dbpool=utils.get_dbpool_stats(),
+                    counter=utils.get_counter_stats(),
+                    caches=cache.get_stats())
 
 
 class TextSaver(saver.Saver):
     doctype = constants.TEXT
 
+    def post_process(self):
+        "The text has changed."
+        cache.reset_texts()
+
 
 class Text(RequestHandler):
     "Edit page for information text."
@@ -2,11 +2,19 @@
 
 import logging
 import os
+import signal
 import sys
 
-import tornado.web
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import tornado.web
 
+from orderportal import asyncdb
+from orderportal import cache
+from orderportal import message
+from orderportal import searchindex
 from orderportal import settings
 from orderportal import utils
 from orderportal import uimodules
@@ -27,6 +35,10 @@ from orderportal.search import *
 
 def main():
     parser = utils.get_command_line_parser(description='OrderPortal server.')
+    parser.add_option('-n', '--processes',
+                      action='store', type='int', dest='processes', default=1,
+                      metavar="N",
+                      help='number of server processes; 0 for one per CPU')
     (options, args) = parser.parse_args()
     utils.load_settings(filepath=options.settings)
     utils.initialize()
@@ -66,7 +78,9 @@ def main():
         url(r'/order/([0-9a-f]{32})/report/edit',
             OrderReportEdit, name='order_report_edit'),
         url(r'/orders', Orders, name='orders'),
+        url(r'/orders/data', OrdersData, name='orders_data'),
         url(r'/api/v1/orders', OrdersApiV1, name='orders_api'),
+        url(r'/api/v1/orders/bulk', OrdersBulkApiV1, name='orders_bulk_api'),
         url(r'/orders.csv', OrdersCsv, name='orders_csv'),
         url(r'/orders.xlsx', OrdersXlsx, name='orders_xlsx'),
         url(r'/accounts', Accounts, name='accounts'),
@@ -176,16 +190,75 @@ def main():
     # This depends on order status setup.
     for key, value in settings['ORDER_STATUSES_LOOKUP'].items():
         value['href'] = application.reverse_url('site', key + '.png')
-    application.listen(settings['PORT'], xheaders=True)
-    pid = os.getpid()
+    asyncdb.configure()
     url = settings['BASE_URL']
     if settings['BASE_URL_PATH_PREFIX']:
         url += settings['BASE_URL_PATH_PREFIX']
-    logging.info("web server %s (PID %s)", url, pid)
+    if options.processes == 1:
+        application.listen(settings['PORT'], xheaders=True)
+        task_id = None
+    else:
+        # The worker processes share the listening socket. The parent
+        # process restarts any worker which dies, and does nothing else.
+        sockets = tornado.netutil.bind_sockets(settings['PORT'])
+        logging.info("web server %s (PID %s) starting workers",
+                     url, os.getpid())
+        if options.pidfile:
+            with open(options.pidfile, 'w') as pf:
+                pf.write(str(os.getpid()))
+        parent_pid = os.getpid()
+        task_id = tornado.process.fork_processes(options.processes)
+        # Nothing may be shared with the parent, or the other workers.
+        utils.reset_process_state()
+        cache.reset_all()
+        server = tornado.httpserver.HTTPServer(application, xheaders=True)
+        server.add_sockets(sockets)
+    pid = os.getpid()
+    if task_id is None:
+        logging.info("web server %s (PID %s)", url, pid)
+    else:
+        logging.info("web server %s worker %s (PID %s)", url, task_id, pid)
+    # Each worker has its own PID file, named by its task id.
     if options.pidfile:
-        with open(options.pidfile, 'w') as pf:
+        filepath = options.pidfile
+        if task_id is not None:
+            root, ext = os.path.splitext(filepath)
+            filepath = "{0}.{1}{2}".format(root, task_id, ext)
+        with open(filepath, 'w') as pf:
             pf.write(str(pid))
-    tornado.ioloop.IOLoop.instance().start()
+    # Keep the in-process caches current with changes in the database.
+    # The changes made by other processes are picked up this way.
+    cache.watch_changes()
+    tornado.ioloop.PeriodicCallback(
+        cache.poll_changes,
+        1000 * settings['DATABASE_CHANGES_INTERVAL']).start()
+    # Load the search index in the background.
+    tornado.ioloop.IOLoop.current().spawn_callback(searchindex.load)
+    # Write the buffered log entries regularly, and when shutting down.
+    tornado.ioloop.PeriodicCallback(
+        utils.flush_log,
+        1000 * settings['LOG_FLUSH_INTERVAL']).start()
+    # Send the queued email messages in the background.
+    tornado.ioloop.PeriodicCallback(
+        lambda: tornado.ioloop.IOLoop.current().spawn_callback(
+            message.process_queue),
+        1000 * settings['MESSAGE_QUEUE_INTERVAL']).start()
+    ioloop = tornado.ioloop.IOLoop.instance()
+    def shutdown(signum, frame):
+        logging.info("web server shutting down (signal %s)", signum)
+        ioloop.add_callback_from_signal(ioloop.stop)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    # A worker shuts down if its parent process has terminated.
+    if task_id is not None:
+        def check_parent():
+            if os.getppid() != parent_pid:
+                logging.info("web server worker %s shutting down"
+                             " (parent terminated)", task_id)
+                ioloop.stop()
+        tornado.ioloop.PeriodicCallback(check_parent, 1000).start()
+    ioloop.start()
+    utils.flush_log()
 
 
 if __name__ == "__main__":
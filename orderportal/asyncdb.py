@@ -0,0 +1,136 @@
+"""Non-blocking access to the CouchDB database for the request handlers.
+The HTTP requests are made using the Tornado AsyncHTTPClient, so that the
+IOLoop can serve other requests while waiting for the database.
+Errors are reported using the exceptions of the 'couchdb' module."""
+
+import json
+import logging
+import urllib.parse
+
+import couchdb
+import couchdb.client
+import tornado.httpclient
+
+from . import constants
+from . import settings
+
+
+def configure():
+    """Configure the HTTP client. The curl-based client is used if 'pycurl'
+    is installed, since it keeps the connections to CouchDB alive for reuse.
+    At most DATABASE_POOL_SIZE requests are made concurrently."""
+    try:
+        import pycurl
+    except ImportError:
+        logging.info("pycurl not installed; async CouchDB connections"
+                     " will not be reused")
+        impl = None
+    else:
+        impl = 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+    tornado.httpclient.AsyncHTTPClient.configure(
+        impl, max_clients=max(settings['DATABASE_POOL_SIZE'], 1))
+
+
+class Database(object):
+    "Non-blocking handle for the CouchDB database."
+
+    def __init__(self, server, name, credentials=None):
+        self.url = server.rstrip('/') + '/' + urllib.parse.quote(name, safe='')
+        self.credentials = credentials
+
+    async def request(self, method, path, query=None, body=None):
+        """Make a request to the database, and return the decoded JSON body.
+        Raise couchdb.ResourceNotFound, couchdb.ResourceConflict or
+        couchdb.ServerError if an error response, IOError if no response."""
+        url = "{0}/{1}".format(self.url, path)
+        if query:
+            url += '?' + urllib.parse.urlencode(query)
+        kwargs = dict(method=method,
+                      headers={'Accept': constants.JSON_MIME},
+                      request_timeout=settings['DATABASE_TIMEOUT'])
+        if body is not None:
+            kwargs['body'] = json.dumps(body)
+            kwargs['headers']['Content-Type'] = constants.JSON_MIME
+        if self.credentials:
+            kwargs['auth_username'], kwargs['auth_password'] = self.credentials
+        client = tornado.httpclient.AsyncHTTPClient()
+        response = await client.fetch(tornado.httpclient.HTTPRequest(url,
+                                                                     **kwargs),
+                                      raise_error=False)
+        if response.code == 599:
+            raise IOError("CouchDB request failed: %s" % response.error)
+        try:
+            data = json.loads(response.body)
+        except (TypeError, ValueError):
+            data = dict()
+        if response.code >= 400:
+            error = (data.get('error'), data.get('reason'))
+            if response.code == 404:
+                raise couchdb.ResourceNotFound(error)
+            elif response.code == 409:
+                raise couchdb.ResourceConflict(error)
+            else:
+                raise couchdb.ServerError((response.code, error))
+        return data
+
+    async def get(self, id):
+        """Return the document given by its id.
+        Raise couchdb.ResourceNotFound if no such document."""
+        return couchdb.client.Document(
+            await self.request('GET', urllib.parse.quote(id, safe='')))
+
+    async def save(self, doc):
+        "Save the document; its '_id' and '_rev' items are updated."
+        if '_id' not in doc:
+            raise ValueError('document has no _id')
+        data = await self.request('PUT',
+                                  urllib.parse.quote(doc['_id'], safe=''),
+                                  body=doc)
+        doc['_rev'] = data['rev']
+
+    async def changes(self, since, limit):
+        """Return the changes made since the given sequence identifier,
+        at most 'limit' of them. The documents are not included."""
+        return await self.request('GET', '_changes',
+                                  query=dict(since=since, limit=limit))
+
+    async def view(self, name, keys=None, **options):
+        """Return the list of rows of the view, given as 'design/view',
+        or as the name of a system view such as '_all_docs'.
+        The options are those of the CouchDB view API."""
+        if name.startswith('_'):
+            path = name
+        else:
+            design, name = name.split('/')
+            path = "_design/{0}/_view/{1}".format(design, name)
+        query = dict()
+        for key, value in options.items():
+            if key in ('key', 'startkey', 'endkey') or \
+               not isinstance(value, str):
+                value = json.dumps(value)
+            query[key] = value
+        if keys is None:
+            data = await self.request('GET', path, query=query)
+        else:
+            data = await self.request('POST', path, query=query,
+                                      body=dict(keys=list(keys)))
+        return [couchdb.client.Row(r) for r in data['rows']]
+
+
+# The process-wide non-blocking database handle.
+_db = None
+
+def get_db():
+    "Return the non-blocking handle for the CouchDB database."
+    global _db
+    if _db is None:
+        if settings.get('DATABASE_ACCOUNT') and \
+           settings.get('DATABASE_PASSWORD'):
+            credentials = (settings['DATABASE_ACCOUNT'],
+                           settings['DATABASE_PASSWORD'])
+        else:
+            credentials = None
+        _db = Database(settings['DATABASE_SERVER'],
+                       settings['DATABASE_NAME'],
+                       credentials=credentials)
+    return _db
@@ -0,0 +1,506 @@
+"Process-level caches of database content, kept current by the changes feed."
+
+import collections
+import copy
+import hashlib
+import hmac
+import logging
+import os
+import time
+
+import couchdb
+import markdown
+
+from . import asyncdb
+from . import constants
+from . import settings
+from . import utils
+from .fields import Fields
+
+# Maximum number of changes fetched at a time from the changes feed.
+CHANGES_BATCH_SIZE = 500
+
+# Functions to call for each change in the database.
+_change_listeners = []
+# The sequence identifier of the latest change that has been processed.
+_changes_since = None
+
+
+def add_change_listener(func):
+    """Register a function to be called for each change in the database.
+    It is called with the change row; a dictionary containing the
+    document id as item 'id', and item 'deleted' if it was deleted.
+    Otherwise item 'doc' is the digest of the document from the view
+    'change/digest'; its doctype, the items of an account needed for
+    the caches, and the items of an order needed for the search index.
+    It is an empty dictionary for a document without doctype."""
+    _change_listeners.append(func)
+
+def watch_changes(db=None):
+    "Start following the changes feed from the current state of the database."
+    global _changes_since
+    if db is None:
+        db = utils.get_db()
+    _changes_since = db.info()['update_seq']
+
+async def poll_changes():
+    """Fetch the changes made since the previous poll and notify
+    the listeners. This is called periodically by the server, and
+    picks up changes also when made by other server processes.
+    The changes are fetched in batches, without the documents; the
+    digests of the changed documents are fetched in one request per batch.
+    The non-blocking database handle is used."""
+    global _changes_since
+    if _changes_since is None: return
+    db = asyncdb.get_db()
+    while True:
+        try:
+            result = await db.changes(_changes_since, CHANGES_BATCH_SIZE)
+            rows = result['results']
+            keys = set([r['id'] for r in rows if not r.get('deleted')])
+            digests = dict()
+            if keys:
+                view = await db.view('change/digest', keys=sorted(keys))
+                digests.update([(r.key, r.value) for r in view])
+        except (couchdb.http.HTTPError, IOError) as msg:
+            logging.error("could not fetch changes feed: %s", msg)
+            return
+        for row in rows:
+            if not row.get('deleted'):
+                row['doc'] = digests.get(row['id'], {})
+            for func in _change_listeners:
+                func(row)
+        _changes_since = result['last_seq']
+        if len(rows) < CHANGES_BATCH_SIZE: break
+
+
+# All bounded caches; for display of statistics.
+_lru_caches = []
+
+class LRUCache(object):
+    """Bounded cache which discards the least recently used item when full.
+    The maximum number of items is given by the named settings variable.
+    The number of hits and misses is recorded.
+    """
+
+    def __init__(self, name, size_setting):
+        self.name = name
+        self.size_setting = size_setting
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        _lru_caches.append(self)
+
+    def get(self, key):
+        "Return the value for the key. Raise KeyError if not in the cache."
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        "Set the value for the key; discard the oldest item if full."
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > max(settings[self.size_setting], 1):
+            self.items.popitem(last=False)
+
+    def discard(self, key):
+        "Remove the item for the key, if any."
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+    def get_stats(self):
+        "Return a dictionary of the statistics."
+        return dict(name=self.name,
+                    count=len(self.items),
+                    size=settings[self.size_setting],
+                    hits=self.hits,
+                    misses=self.misses)
+
+def get_stats():
+    "Return a list of statistics dictionaries for all bounded caches."
+    return [c.get_stats() for c in _lru_caches]
+
+def reset_all():
+    """Clear all cached data; it will be read again when needed.
+    Used when the changes feed is not known to cover the cached data."""
+    for lru_cache in _lru_caches:
+        lru_cache.clear()
+    reset_global_modes()
+    reset_template_items()
+    reset_texts()
+    reset_forms()
+    reset_groups_graph()
+    reset_account_roles()
+
+
+# The global modes; None if not yet read from the database.
+_global_modes = None
+
+def get_global_modes(db):
+    """Return a copy of the global modes.
+    The database is read only if the modes are not in the cache."""
+    global _global_modes
+    if _global_modes is None:
+        modes = constants.DEFAULT_GLOBAL_MODES.copy()
+        try:
+            modes.update(db['global_modes'])
+        except couchdb.ResourceNotFound:
+            pass
+        _global_modes = modes
+    return _global_modes.copy()
+
+def set_global_modes(modes):
+    "Set the cached global modes to a copy of the given, just saved."
+    global _global_modes
+    _global_modes = modes.copy()
+
+def reset_global_modes():
+    "Clear the cached global modes; they will be read again when needed."
+    global _global_modes
+    _global_modes = None
+
+def _global_modes_listener(row):
+    if row['id'] == 'global_modes':
+        reset_global_modes()
+
+add_change_listener(_global_modes_listener)
+
+
+# Items for the template namespace of every page; the info pages menu.
+_template_items = dict()
+
+def get_infos_menu(db):
+    "Return the list of (name, title) for the info pages in the menu."
+    try:
+        return _template_items['infos']
+    except KeyError:
+        result = [r.value for r in db.view('info/menu')]
+        _template_items['infos'] = result
+        return result
+
+def get_alert(db):
+    "Return the alert text rendered as HTML, or None if none."
+    return get_text_html(db, 'alert')
+
+def reset_template_items():
+    "Clear the cached template items; they will be read again when needed."
+    _template_items.clear()
+
+def _template_items_listener(row):
+    if row.get('deleted') or \
+       row['doc'].get(constants.DOCTYPE) == constants.INFO:
+        reset_template_items()
+
+add_change_listener(_template_items_listener)
+
+
+# Rendered HTML of Markdown, keyed by hash of the Markdown source.
+markdown_html = LRUCache('Markdown', 'CACHE_MARKDOWN_SIZE')
+
+def get_markdown_html(text):
+    "Return the HTML for the Markdown text; rendered only if not cached."
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    try:
+        return markdown_html.get(key)
+    except KeyError:
+        result = markdown.markdown(text, output_format='html5')
+        markdown_html.set(key, result)
+        return result
+
+# Rendered HTML of text documents, keyed by name and document revision.
+texts_html = LRUCache('Text', 'CACHE_TEXT_SIZE')
+# The revision of the current text document for each name;
+# None if there is no such text, or if it is empty.
+_texts_rev = dict()
+
+def get_text_html(db, name):
+    """Return the HTML for the named text, or None if no such text,
+    or if it is empty. A text is rendered only once per revision."""
+    try:
+        rev = _texts_rev[name]
+    except KeyError:
+        rows = list(db.view('text/name', key=name, include_docs=True))
+        if len(rows) == 1 and rows[0].doc.get('text'):
+            doc = rows[0].doc
+            rev = doc['_rev']
+            if (name, rev) not in texts_html.items:
+                texts_html.set((name, rev),
+                               markdown.markdown(doc['text'],
+                                                 output_format='html5'))
+        else:
+            rev = None
+        _texts_rev[name] = rev
+    if rev is None: return None
+    try:
+        return texts_html.get((name, rev))
+    except KeyError:            # Discarded from the cache; fetch again.
+        _texts_rev.pop(name, None)
+        return get_text_html(db, name)
+
+def reset_texts():
+    "Forget the current text revisions; they will be read again when needed."
+    _texts_rev.clear()
+
+def _texts_listener(row):
+    if row.get('deleted') or \
+       row['doc'].get(constants.DOCTYPE) == constants.TEXT:
+        reset_texts()
+
+add_change_listener(_texts_listener)
+
+
+# Account documents for authentication, keyed by document id.
+# The value is a tuple (account, expiry time).
+accounts = LRUCache('Account', 'CACHE_ACCOUNT_SIZE')
+# Account document id, keyed by tuple (view name, key); email or API key.
+accounts_id = LRUCache('Account key', 'CACHE_ACCOUNT_SIZE')
+# Hashed password, keyed by an HMAC of the HTTP Basic authentication
+# header value, so that the credentials it contains are not kept in memory.
+basic_auth_hashed = LRUCache('Basic auth', 'CACHE_ACCOUNT_SIZE')
+_basic_auth_secret = os.urandom(32)
+
+def get_account(db, viewname, key, field):
+    """Return a copy of the account document given by the key in the view,
+    which must be the value of the given field of the document.
+    Return None if no such account.
+    A cached account is used if recent. When older than CACHE_ACCOUNT_TTL,
+    it is used only if its revision in the database is unchanged.
+    A change made by another server process, such as disabling the
+    account, is seen here only when the changes feed has been polled,
+    or the cached account is older than CACHE_ACCOUNT_TTL."""
+    try:
+        iuid = accounts_id.get((viewname, key))
+        account, expires = accounts.get(iuid)
+        if account.get(field) != key: raise KeyError
+    except KeyError:
+        rows = list(db.view(viewname, key=key, include_docs=True))
+        if len(rows) != 1: return None
+        account = rows[0].doc
+        accounts_id.set((viewname, key), account['_id'])
+    else:
+        if time.time() > expires:
+            try:
+                status, headers, data = db.resource.head(iuid)
+                if headers['ETag'].strip('"') != account['_rev']:
+                    raise KeyError
+            except (couchdb.ResourceNotFound, KeyError):
+                discard_account(iuid)
+                return get_account(db, viewname, key, field)
+    accounts.set(account['_id'],
+                 (account, time.time() + settings['CACHE_ACCOUNT_TTL']))
+    return copy.deepcopy(account)
+
+def get_basic_auth_hashed(auth, password):
+    """Return the hashed password for the HTTP Basic authentication
+    header value, which contains the given password."""
+    key = hmac.new(_basic_auth_secret, auth.encode(), hashlib.sha256).digest()
+    try:
+        return basic_auth_hashed.get(key)
+    except KeyError:
+        hashed = utils.hashed_password(password)
+        basic_auth_hashed.set(key, hashed)
+        return hashed
+
+def discard_account(iuid):
+    "Remove the account given by its document id from the cache."
+    accounts.discard(iuid)
+
+def _accounts_listener(row):
+    discard_account(row['id'])
+
+add_change_listener(_accounts_listener)
+
+
+# Account person name, keyed by email.
+account_names = LRUCache('Account name', 'CACHE_ACCOUNT_SIZE')
+
+def get_account_names(db, emails):
+    """Return a lookup of person name for the accounts given by email.
+    Names not in the cache are fetched in one request.
+    The name for an email of a non-existent account is '[unknown]'."""
+    result = {}
+    missing = {}
+    for email in emails:
+        key = email.strip().lower()
+        try:
+            result[email] = account_names.get(key)
+        except KeyError:
+            missing.setdefault(key, []).append(email)
+    if missing:
+        view = db.view('account/email', keys=sorted(missing))
+        for row in view:
+            name = utils.get_account_name(value=row.value)
+            account_names.set(row.key, name)
+            for email in missing.pop(row.key, []):
+                result[email] = name
+        for emails in missing.values():
+            for email in emails:
+                result[email] = '[unknown]'
+    return result
+
+def discard_account_name(email):
+    "Remove the name of the account given by email from the cache."
+    account_names.discard(email)
+
+def _account_names_listener(row):
+    # The email of a deleted account is not known; clear all names.
+    if row.get('deleted'):
+        account_names.clear()
+    elif row['doc'].get(constants.DOCTYPE) == constants.ACCOUNT:
+        discard_account_name(row['doc']['email'])
+
+add_change_listener(_account_names_listener)
+
+
+# Form documents and their Fields objects, keyed by tuple (IUID, revision).
+forms = LRUCache('Form', 'CACHE_FORM_SIZE')
+# The current revision of each form, keyed by IUID.
+_forms_rev = dict()
+
+def get_form(db, iuid):
+    """Return the tuple (form, Fields object) for the form given by IUID.
+    Raise KeyError if no such form. The form is read from the database
+    only if its current revision is not in the cache. The form document
+    and the Fields object are shared, and must not be modified."""
+    try:
+        return forms.get((iuid, _forms_rev[iuid]))
+    except KeyError:
+        try:
+            form = db[iuid]
+        except couchdb.ResourceNotFound:
+            raise KeyError(iuid)
+        if form.get(constants.DOCTYPE) != constants.FORM:
+            raise KeyError(iuid)
+        result = (form, Fields(form))
+        forms.set((iuid, form['_rev']), result)
+        _forms_rev[iuid] = form['_rev']
+        return result
+
+def discard_form(iuid):
+    "Forget the current revision of the form; it will be read when needed."
+    _forms_rev.pop(iuid, None)
+
+def reset_forms():
+    "Forget the current revisions of all forms."
+    _forms_rev.clear()
+
+def _forms_listener(row):
+    if row.get('deleted') or \
+       row['doc'].get(constants.DOCTYPE) == constants.FORM:
+        discard_form(row['id'])
+
+add_change_listener(_forms_listener)
+
+
+# The groups graph; None if not yet read from the database.
+_groups_graph = None
+
+def get_groups_graph(db):
+    """Return the tuple (groups, memberships) where 'groups' is a lookup
+    of all group documents keyed by IUID, and 'memberships' a lookup of
+    the list of IUIDs of the groups, sorted by name, keyed by member email.
+    The database is read only if the graph is not in the cache.
+    The group documents must not be modified."""
+    global _groups_graph
+    if _groups_graph is None:
+        view = db.view('group/modified', reduce=False, include_docs=True)
+        groups = dict([(r.id, r.doc) for r in view])
+        memberships = {}
+        for group in sorted(groups.values(), key=lambda g: g['name']):
+            for member in group['members']:
+                memberships.setdefault(member, []).append(group['_id'])
+        _groups_graph = (groups, memberships)
+    return _groups_graph
+
+def reset_groups_graph():
+    "Clear the cached groups graph; it will be read again when needed."
+    global _groups_graph
+    _groups_graph = None
+    message_recipients.clear()
+
+def _groups_graph_listener(row):
+    if row.get('deleted') or \
+       row['doc'].get(constants.DOCTYPE) == constants.GROUP:
+        reset_groups_graph()
+
+add_change_listener(_groups_graph_listener)
+
+
+# The tuple (status, role) of each account, keyed by email;
+# None if not yet read from the database.
+_account_roles = None
+# The emails of the recipients for messages about orders,
+# keyed by tuple (owner email, kinds of recipients).
+message_recipients = LRUCache('Message recipients', 'CACHE_ACCOUNT_SIZE')
+
+def get_account_roles(db):
+    """Return a lookup of the tuple (status, role) for all accounts,
+    keyed by email. The database is read only if not in the cache."""
+    global _account_roles
+    if _account_roles is None:
+        statuses = dict([(r.value, r.key) for r in db.view('account/status')])
+        roles = dict([(r.value, r.key) for r in db.view('account/role')])
+        _account_roles = dict([(email, (status, roles.get(email)))
+                               for email, status in statuses.items()])
+    return _account_roles
+
+def update_account_role(account):
+    "Update the cached status and role for the account just saved."
+    if _account_roles is not None:
+        value = (account.get('status'), account.get('role'))
+        if _account_roles.get(account['email']) == value: return
+        _account_roles[account['email']] = value
+    message_recipients.clear()
+
+def reset_account_roles():
+    "Clear the cached account roles; they will be read again when needed."
+    global _account_roles
+    _account_roles = None
+    message_recipients.clear()
+
+def get_message_recipients(db, owner, kinds):
+    """Return the sorted list of emails of the recipients of a message
+    about an order owned by the given account. The kinds of recipients
+    are 'owner', 'group' (enabled accounts in the owner's groups) and
+    'admin' (enabled admin accounts). Only the kinds for an owner
+    account which exists are included."""
+    kinds = tuple(sorted(set(kinds)))
+    try:
+        return message_recipients.get((owner, kinds))
+    except KeyError:
+        pass
+    roles = get_account_roles(db)
+    enabled = lambda email: roles.get(email, (None,))[0] == constants.ENABLED
+    result = set()
+    email = owner.strip().lower()
+    if email in roles:
+        if 'owner' in kinds:
+            result.add(email)
+        if 'group' in kinds:
+            groups, memberships = get_groups_graph(db)
+            for iuid in memberships.get(email, []):
+                result.update([m for m in groups[iuid]['members']
+                               if enabled(m)])
+    if constants.ADMIN in kinds:
+        result.update([e for e, (status, role) in roles.items()
+                       if role == constants.ADMIN and enabled(e)])
+    result = sorted(result)
+    message_recipients.set((owner, kinds), result)
+    return result
+
+def _account_roles_listener(row):
+    # The email of a deleted account is not known; clear all.
+    if row.get('deleted'):
+        reset_account_roles()
+    elif row['doc'].get(constants.DOCTYPE) == constants.ACCOUNT:
+        update_account_role(row['doc'])
+
+add_change_listener(_account_roles_listener)
@@ -107,9 +107,23 @@ SUBMITTED = 'submitted'
 TESTING = 'testing'
 FORM_STATUSES = [PENDING, TESTING, ENABLED, DISABLED]
 
+# Size of chunks of file content written to the client.
+CHUNK_SIZE = 65536
+
+# Retries of a counter block reservation on update conflict, and the
+# bounds of the random delay (seconds) before each retry.
+COUNTER_RETRIES = 10
+COUNTER_RETRY_DELAY = 0.005
+COUNTER_RETRY_MAX_DELAY = 0.1
+
+# Maximum number of log entries kept in the buffer while the database
+# cannot be written to; the oldest are discarded beyond this.
+LOG_BUFFER_MAX = 10000
+
 # Content types (MIME types)
 HTML_MIME = 'text/html'
 JSON_MIME = 'application/json'
+NDJSON_MIME = 'application/x-ndjson'
 CSV_MIME  = 'text/csv'
 ZIP_MIME  = 'application/zip'
 TEXT_MIME = 'text/plain'
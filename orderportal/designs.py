@@ -1,5 +1,6 @@
 "CouchDB design documents (view index definitions)."
 
+import json
 import logging
 
 import couchdb
@@ -129,6 +130,12 @@ DESIGNS = dict(
     for (var i=0; i<doc.recipients.length; i++) {
 	emit([doc.recipients[i], doc.modified], 1);
     };
+}"""),
+        queued=dict(map=        # message/queued
+"""function(doc) {
+    if (doc.orderportal_doctype !== 'message') return;
+    if (!doc.queued) return;
+    emit(doc.queued, null);
 }""")),
 
     meta=dict(
@@ -150,7 +157,7 @@ DESIGNS = dict(
                   map=
 """function(doc) {
     if (doc.orderportal_doctype !== 'order') return;
-    emit([doc.form, doc.modified], 1);
+    emit([doc.form, doc.modified], summarize(doc));
 }"""),
         identifier=dict(map=    # order/identifier
 """function(doc) {
@@ -172,19 +179,25 @@ var lint = {lint};
         modified=dict(map=      # order/modified
 """function(doc) {
     if (doc.orderportal_doctype !== 'order') return;
-    emit(doc.modified, doc.title);
+    emit(doc.modified, summarize(doc));
 }"""),
         owner=dict(reduce="_count", # order/owner
                    map=
 """function(doc) {
     if (doc.orderportal_doctype !== 'order') return;
-    emit([doc.owner, doc.modified], 1);
+    emit([doc.owner, doc.modified], summarize(doc));
 }"""),
         status=dict(reduce="_count", # order/status
                     map=
 """function(doc) {
     if (doc.orderportal_doctype !== 'order') return;
-    emit([doc.status, doc.modified], 1);
+    emit([doc.status, doc.modified], summarize(doc));
+}"""),
+        status_form=dict(reduce="_count", # order/status_form
+                         map=
+"""function(doc) {
+    if (doc.orderportal_doctype !== 'order') return;
+    emit([doc.status, doc.form, doc.modified], summarize(doc));
 }"""),
         tag=dict(map=           # order/tag
 """function(doc) {
@@ -228,6 +241,72 @@ ORDERS_SEARCH_FIELDS_MAP = """function(doc) {{
 }};
 var lint = {lint};"""
 
+# Double {{ and }} are converted to single such by .format
+ORDERS_LIST_FIELDS_MAP = """function(doc) {{
+  if (doc.orderportal_doctype !== 'order') return;
+  var value = doc.fields.{fieldid};
+  if (value === undefined) value = null;
+  emit([value, doc.modified], summarize(doc));
+}}"""
+
+# The order views whose values are the order summaries; the function
+# 'summarize' is appended to their map functions. See 'get_all_items'.
+ORDER_SUMMARY_VIEWS = ('form', 'modified', 'owner', 'status', 'status_form')
+
+# Double {{ and }} are converted to single such by .format
+ORDER_SUMMARY_FUNCTION = """;
+var summarize = function(doc) {{
+  var summary = {{_id: doc._id,
+                 orderportal_doctype: 'order',
+                 title: doc.title || '',
+                 form: doc.form,
+                 owner: doc.owner,
+                 status: doc.status,
+                 tags: doc.tags || [],
+                 fields: {{}},
+                 history: {{}},
+                 modified: doc.modified}};
+  if (doc.identifier) summary.identifier = doc.identifier;
+  var fields = doc.fields || {{}};
+  {fieldids}.forEach(function(id) {{
+    var value = fields[id];
+    summary.fields[id] = (value === undefined) ? null : value;
+  }});
+  var history = doc.history || {{}};
+  {statuses}.forEach(function(status) {{
+    summary.history[status] = history[status] || null;
+  }});
+  return summary;
+}};"""
+
+ORDER_SUMMARY_MAP = """function(doc) {
+  if (doc.orderportal_doctype !== 'order') return;
+  emit(doc._id, summarize(doc));
+}"""
+
+# Double {{ and }} are converted to single such by .format
+CHANGE_DIGEST_MAP = """function(doc) {{
+  if (!doc.orderportal_doctype) return;
+  var digest = {{orderportal_doctype: doc.orderportal_doctype}};
+  if (doc.orderportal_doctype === 'account') {{
+    digest.email = doc.email;
+    digest.status = doc.status;
+    digest.role = doc.role;
+  }} else if (doc.orderportal_doctype === 'order') {{
+    digest._id = doc._id;
+    digest.identifier = doc.identifier || null;
+    digest.title = doc.title || null;
+    digest.tags = doc.tags || [];
+    digest.owner = doc.owner;
+    digest.modified = doc.modified;
+    digest.fields = {{}};
+    var fields = doc.fields || {{}};
+    {fieldids}.forEach(function(id) {{
+      if (fields[id] !== undefined) digest.fields[id] = fields[id];
+    }});
+  }};
+  emit(doc._id, digest);
+}}"""
 
 def load_design_documents(db):
     "Load the design documents (view index definitions)."
@@ -251,7 +330,18 @@ def get_all_items():
     delims_lint = ''.join(settings['ORDERS_SEARCH_DELIMS_LINT'])
     lint = "{%s}" % ', '.join(["'%s': 1" % w
                                for w in settings['ORDERS_SEARCH_LINT']])
-    items = list(DESIGNS.items())
+    summarize = ORDER_SUMMARY_FUNCTION.format(
+        fieldids=json.dumps([f['identifier']
+                             for f in settings['ORDERS_LIST_FIELDS']]),
+        statuses=json.dumps(settings['ORDERS_LIST_STATUSES']))
+    items = []
+    for entity, views in DESIGNS.items():
+        if entity == 'order':
+            views = views.copy()
+            for name in ORDER_SUMMARY_VIEWS:
+                views[name] = dict(views[name],
+                                   map=views[name]['map'] + summarize)
+        items.append((entity, views))
     fields = dict()
     for field in settings['ORDERS_SEARCH_FIELDS']:
         if not constants.ID_RX.match(field):
@@ -262,6 +352,21 @@ def get_all_items():
             delims_lint=delims_lint,
             lint=lint))
     items.append(('fields', fields))
+    fields = dict()
+    for field in settings['ORDERS_LIST_FIELDS']:
+        if not constants.ID_RX.match(field['identifier']):
+            logging.debug("IGNORED list field %s invalid identifier.",
+                          field['identifier'])
+            continue
+        fields[field['identifier']] = dict(
+            reduce="_count",
+            map=ORDERS_LIST_FIELDS_MAP.format(fieldid=field['identifier']) +
+            summarize)
+    items.append(('list_fields', fields))
+    items.append(('summary', dict(order=dict(map=ORDER_SUMMARY_MAP +
+                                                 summarize))))
+    items.append(('change', dict(digest=dict(map=CHANGE_DIGEST_MAP.format(
+        fieldids=json.dumps(settings['ORDERS_SEARCH_FIELDS']))))))
     return items
 
 def update_design_document(db, entity, views):
@@ -65,5 +65,5 @@ class Event(RequestHandler):
 class Events(RequestHandler):
     "List of all events."
 
-    def get(self):
-        self.render('events.html', events=self.get_events())
+    async def get(self):
+        self.render('events.html', events=await self.get_events())
@@ -3,6 +3,7 @@
 
 
 import logging
+import urllib.parse
 
 import tornado.web
 
@@ -21,6 +22,15 @@ class Fields(object):
 
     def setup(self):
         self._lookup = dict([(f['identifier'], f) for f in self.flatten()])
+        self._validator = None
+
+    def get_validator(self):
+        """Return the Validator for the fields. It is compiled when first
+        needed, so it is shared with the Fields object for the form revision.
+        """
+        if self._validator is None:
+            self._validator = Validator(self)
+        return self._validator
 
     def flatten(self, fields=None, depth=0, parent=None):
         """Pre-order traversal to produce a list of all fields.
@@ -280,3 +290,308 @@ class Fields(object):
                 return
             if field['type'] == constants.GROUP:
                 self._delete(field['fields'], identifier)
+
+
+# Kinds of step in the validation program.
+_FIELD = 0
+_GROUP = 1
+_END = 2
+
+
+class Validator(object):
+    """Check the validity of the field values of an order.
+    The fields of the form are compiled into a flat program, which
+    is run in a single linear pass over the values. A group is
+    represented by a start and an end step; a field or group which
+    is not visible is skipped by jumping past its steps.
+    The dependencies between fields are also recorded, so that only
+    the fields affected by a change need to be checked again.
+    """
+
+    def __init__(self, fields):
+        # Each step is a tuple (kind, identifier, visible_if, skip,
+        # check, required, options) where 'visible_if' is None or a tuple
+        # (identifier, lowercase value), 'skip' is the position of the step
+        # following those of the field, 'check' is the function for the
+        # field type, and 'options' the set of alternatives, if any.
+        self.steps = []
+        # Lookup of the position of the first step for each field.
+        self.positions = dict()
+        # Lookup of the enclosing group for each field; None if top level.
+        self.parents = dict()
+        # Lookup of the fields in each group.
+        self.children = dict()
+        # Lookup of the fields whose visibility depends on a field.
+        self.dependents = dict()
+        # Lookup of the column value converters for each table field.
+        self.table_columns = dict()
+        self.compile(fields.form['fields'])
+
+    def compile(self, fields, parent=None):
+        "Append the steps for the given fields, recursively for groups."
+        for field in fields:
+            identifier = field['identifier']
+            visible_if = None
+            if field.get('visible_if_field'):
+                if_value = field.get('visible_if_value')
+                if if_value:
+                    if_value = if_value.lower()
+                visible_if = (field['visible_if_field'], if_value)
+                self.dependents.setdefault(field['visible_if_field'], []) \
+                               .append(identifier)
+            pos = len(self.steps)
+            self.positions[identifier] = pos
+            self.parents[identifier] = parent
+            if parent is not None:
+                self.children[parent].append(identifier)
+            if field['type'] == constants.GROUP:
+                self.children[identifier] = []
+                self.steps.append(None)
+                self.compile(field['fields'], parent=identifier)
+                self.steps.append((_END, identifier,
+                                   None, None, None, None, None))
+                self.steps[pos] = (_GROUP, identifier, visible_if,
+                                   len(self.steps), None, None, None)
+            else:
+                options = None
+                if field['type'] == constants.SELECT:
+                    options = frozenset(field['select'])
+                elif field['type'] == constants.MULTISELECT:
+                    options = frozenset(field['multiselect'])
+                elif field['type'] == constants.TABLE:
+                    self.table_columns[identifier] = \
+                        [_get_column_converter(utils.parse_field_table_column(c))
+                         for c in field['table']]
+                self.steps.append((_FIELD, identifier, visible_if,
+                                   pos + 1, _CHECKS.get(field['type']),
+                                   field['required'], options))
+
+    def validate(self, values):
+        """Check the values, converting those of some field types in place.
+        Return a dictionary of the error messages for the invalid fields.
+        """
+        invalid = dict()
+        failures = [False]      # Stack of failure flags for nested groups.
+        steps = self.steps
+        length = len(steps)
+        pos = 0
+        while pos < length:
+            kind, identifier, visible_if, skip, check, required, options = \
+                steps[pos]
+            pos += 1
+            if kind == _END:
+                if failures.pop():
+                    invalid[identifier] = 'subfield(s) invalid'
+                    failures[-1] = True
+                continue
+            if visible_if is not None:
+                select_value = values.get(visible_if[0])
+                if select_value is not None:
+                    select_value = str(select_value).lower()
+                if select_value != visible_if[1]:
+                    pos = skip
+                    continue
+            if kind == _GROUP:
+                failures.append(False)
+                continue
+            try:
+                value = values[identifier]
+                if value is None:
+                    if required:
+                        raise ValueError('missing value')
+                elif check is not None:
+                    value = check(value, required, options)
+                    if value is not None:
+                        values[identifier] = value
+            except ValueError as msg:
+                invalid[identifier] = str(msg)
+                failures[-1] = True
+            except Exception as msg:
+                invalid[identifier] = "System error: %s" % msg
+                failures[-1] = True
+        return invalid
+
+    def revalidate(self, values, invalid, changed):
+        """Check again only the fields affected by a change in the values
+        of the given fields: the fields themselves, the fields and groups
+        whose visibility depends on them, and the groups enclosing these.
+        Convert values in place, and update the dictionary 'invalid'
+        of error messages for the invalid fields in place.
+        """
+        groups = set()
+        pending = [i for i in changed if i in self.positions]
+        while pending:
+            identifier = pending.pop()
+            # The field itself and all fields within dependent groups.
+            pos = self.positions[identifier]
+            steps = self.steps[pos:self.steps[pos][3]]
+            for dependent in self.dependents.get(identifier, []):
+                pos = self.positions[dependent]
+                steps.extend(self.steps[pos:self.steps[pos][3]])
+            for step in steps:
+                if step[0] == _END: continue
+                invalid.pop(step[1], None)
+                groups.add(self.parents[step[1]])
+                if step[0] == _GROUP:
+                    groups.add(step[1])
+                elif self.is_visible(step[1], values):
+                    before = values.get(step[1])
+                    error = _get_error(step, values)
+                    if error:
+                        invalid[step[1]] = error
+                    # A converted value may change the visibility of others.
+                    if values.get(step[1]) != before and \
+                       step[1] in self.dependents:
+                        pending.append(step[1])
+        # Add all enclosing groups, and check the innermost ones first.
+        for identifier in list(groups):
+            while identifier is not None:
+                groups.add(identifier)
+                identifier = self.parents[identifier]
+        groups.discard(None)
+        for identifier in sorted(groups,
+                                 key=lambda i: self.positions[i],
+                                 reverse=True):
+            invalid.pop(identifier, None)
+            if not self.is_visible(identifier, values): continue
+            for child in self.children[identifier]:
+                if child in invalid:
+                    invalid[identifier] = 'subfield(s) invalid'
+                    break
+
+    def is_visible(self, identifier, values):
+        "Are the field and all groups enclosing it visible?"
+        while identifier is not None:
+            if not _is_shown(self.steps[self.positions[identifier]][2],
+                             values):
+                return False
+            identifier = self.parents[identifier]
+        return True
+
+
+def _is_shown(visible_if, values):
+    "Is the condition for visibility, if any, fulfilled by the values?"
+    if visible_if is None: return True
+    select_value = values.get(visible_if[0])
+    if select_value is not None:
+        select_value = str(select_value).lower()
+    return select_value == visible_if[1]
+
+def _get_error(step, values):
+    """Check the value of the field given by the step, converting it in place.
+    Return the error message if invalid, else None."""
+    identifier, check, required, options = step[1], step[4], step[5], step[6]
+    try:
+        value = values[identifier]
+        if value is None:
+            if required:
+                raise ValueError('missing value')
+        elif check is not None:
+            value = check(value, required, options)
+            if value is not None:
+                values[identifier] = value
+    except ValueError as msg:
+        return str(msg)
+    except Exception as msg:
+        return "System error: %s" % msg
+
+
+# The check functions for field values that are not None. Each returns
+# the converted value, or None if not converted. Raise ValueError if invalid.
+
+def _check_email(value, required, options):
+    if not constants.EMAIL_RX.match(value):
+        raise ValueError('not a valid email address')
+
+def _check_int(value, required, options):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('not an integer value')
+
+def _check_float(value, required, options):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError('not a float value')
+
+def _check_boolean(value, required, options):
+    try:
+        return utils.to_bool(value)
+    except (TypeError, ValueError):
+        raise ValueError('not a boolean value')
+
+def _check_url(value, required, options):
+    parsed = urllib.parse.urlparse(value)
+    if not (parsed.scheme and parsed.netloc):
+        raise ValueError('incomplete URL')
+
+def _check_select(value, required, options):
+    try:
+        if value in options: return
+    except TypeError:           # Unhashable value.
+        pass
+    raise ValueError('value not among alternatives')
+
+def _check_multiselect(value, required, options):
+    if not isinstance(value, list):
+        raise ValueError('value is not a list')
+    if required and len(value) == 1 and value[0] == '':
+        raise ValueError('missing value')
+    for v in value:
+        if not v: continue
+        try:
+            if v in options: continue
+        except TypeError:       # Unhashable value.
+            pass
+        raise ValueError('value not among alternatives')
+
+def _check_text(value, required, options):
+    if not isinstance(value, str):
+        raise ValueError('value is not a text string')
+
+def _check_date(value, required, options):
+    if not constants.DATE_RX.match(value):
+        raise ValueError('value is not a valid date')
+
+def _check_table(value, required, options):
+    if not isinstance(value, list):
+        raise ValueError('table value is not a list')
+    if required and len(value) == 0:
+        raise ValueError('missing data')
+    for r in value:
+        if not isinstance(r, list):
+            raise ValueError('table value is not a list of lists')
+
+_CHECKS = {constants.EMAIL: _check_email,
+           constants.INT: _check_int,
+           constants.FLOAT: _check_float,
+           constants.BOOLEAN: _check_boolean,
+           constants.URL: _check_url,
+           constants.SELECT: _check_select,
+           constants.MULTISELECT: _check_multiselect,
+           constants.TEXT: _check_text,
+           constants.DATE: _check_date,
+           constants.TABLE: _check_table}
+
+def _get_column_converter(column):
+    "Return a function converting a value for the parsed table column."
+    if column['type'] == constants.SELECT:
+        options = frozenset(column['options'])
+        def convert(value):
+            try:
+                if value not in options: return None
+            except TypeError:   # Unhashable value.
+                return None
+            if value == '[no value]': return None
+            return value
+    elif column['type'] == constants.INT:
+        def convert(value):
+            try:
+                return int(value)
+            except (ValueError, TypeError):
+                return None
+    else:
+        def convert(value):
+            return value or None
+    return convert
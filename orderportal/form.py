@@ -6,6 +6,7 @@ from collections import OrderedDict as OD
 import tornado.web
 import simplejson as json       # XXX Python 3 kludge
 
+from . import cache
 from . import constants
 from . import saver
 from . import settings
@@ -25,6 +26,10 @@ class FormSaver(saver.Saver):
     def setup(self):
         self.fields = Fields(self.doc)
 
+    def post_process(self):
+        "The cached form, if any, must not be used."
+        cache.discard_form(self.doc['_id'])
+
     def add_field(self):
         identifier = self.rqh.get_argument('identifier')
         if not constants.ID_RX.match(identifier):
@@ -85,7 +90,7 @@ class Forms(FormMixin, RequestHandler):
         view = self.db.view('form/modified', descending=True, include_docs=True)
         title = 'Recent forms'
         forms = [r.doc for r in view]
-        names = self.get_account_names()
+        names = self.get_account_names(set([f['owner'] for f in forms]))
         counts = dict([(f['_id'], self.get_order_count(f))
                        for f in forms])
         self.render('forms.html',
@@ -129,6 +134,7 @@ class Form(FormMixin, RequestHandler):
             return
         self.delete_logs(form['_id'])
         self.db.delete(form)
+        cache.discard_form(form['_id'])
         self.see_other('forms')
 
     def is_deletable(self, form):
@@ -474,17 +480,17 @@ class FormOrders(RequestHandler):
     "Page for a list of all orders for a given form."
 
     @tornado.web.authenticated
-    def get(self, iuid):
+    async def get(self, iuid):
         self.check_staff()
         form = self.get_entity(iuid, doctype=constants.FORM)
-        view = self.db.view('order/form',
-                            reduce=False,
-                            include_docs=True,
-                            descending=True,
-                            startkey=[iuid, constants.CEILING],
-                            endkey=[iuid])
-        orders = [r.doc for r in view]
-        account_names = self.get_account_names()
+        view = await self.async_db.view('order/form',
+                                        reduce=False,
+                                        descending=True,
+                                        startkey=[iuid, constants.CEILING],
+                                        endkey=[iuid])
+        orders = [r.value for r in view]
+        account_names = self.get_account_names(
+            set([o['owner'] for o in orders]))
         self.render('form_orders.html',
                     form=form,
                     orders=orders,
@@ -510,7 +516,7 @@ class FormOrdersAggregate(RequestHandler):
                     fields=fields, table_fields=table_fields)
 
     @tornado.web.authenticated
-    def post(self, iuid):
+    async def post(self, iuid):
         self.check_staff()
         form = self.get_entity(iuid, doctype=constants.FORM)
 
@@ -545,13 +551,13 @@ class FormOrdersAggregate(RequestHandler):
         writer.writerow(header)
 
         account_lookup = {}
-        # Get all orders for the given form.
-        view = self.db.view('order/form',
-                            reduce=False,
-                            include_docs=True,
-                            descending=True,
-                            startkey=[iuid, constants.CEILING],
-                            endkey=[iuid])
+        # Get all orders for the given form; all fields are needed.
+        view = await self.async_db.view('order/form',
+                                        reduce=False,
+                                        include_docs=True,
+                                        descending=True,
+                                        startkey=[iuid, constants.CEILING],
+                                        endkey=[iuid])
         orders = [r.doc for r in view]
 
         # Filter by statuses, if any given
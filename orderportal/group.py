@@ -7,6 +7,7 @@ import logging
 import tornado.web
 
 import orderportal
+from orderportal import cache
 from orderportal import constants
 from orderportal import saver
 from orderportal import settings
@@ -17,6 +18,10 @@ from orderportal.requesthandler import RequestHandler
 class GroupSaver(saver.Saver):
     doctype = constants.GROUP
 
+    def post_process(self):
+        "The membership of groups may have changed."
+        cache.reset_groups_graph()
+
 
 class Groups(RequestHandler):
     "Page for a list of all groups."
@@ -82,6 +87,7 @@ class Group(GroupMixin, RequestHandler):
         self.check_editable(group)
         self.delete_logs(group['_id'])
         self.db.delete(group)
+        cache.reset_groups_graph()
         self.see_other('account', self.current_user['email'])
 
 
@@ -9,6 +9,7 @@ from collections import OrderedDict as OD
 import couchdb
 import markdown
 import tornado
+import tornado.gen
 import tornado.web
 import yaml
 
@@ -23,76 +24,84 @@ from orderportal.requesthandler import RequestHandler
 class Home(RequestHandler):
     "Home page; dashboard. Contents according to role of logged-in account."
 
-    def get(self):
-        forms = [r.doc for r in self.db.view('form/enabled', include_docs=True)]
+    async def get(self):
+        # The database requests are made concurrently.
+        requests = dict(
+            forms=self.async_db.view('form/enabled', include_docs=True),
+            news_items=self.get_news(limit=settings['DISPLAY_MAX_NEWS']),
+            events=self.get_events(upcoming=True))
+        if self.current_user:
+            requests['invitations'] = self.get_invitations(
+                self.current_user['email'])
+        results = await tornado.gen.multi(requests)
+        forms = [r.doc for r in results['forms']]
         for f in forms:
             if f.get('ordinal') is None: f['ordinal'] = 0
         forms.sort(key=lambda i: i['ordinal'])
         kwargs = dict(
             forms=forms,
-            news_items=self.get_news(limit=settings['DISPLAY_MAX_NEWS']),
-            events=self.get_events(upcoming=True))
-        if self.current_user and self.get_invitations(self.current_user['email']):
+            news_items=results['news_items'],
+            events=results['events'])
+        if results.get('invitations'):
             url = self.reverse_url('account', self.current_user['email'])
             kwargs['message'] = """You have group invitations.
 See your <a href="{0}">account</a>.""".format(url)
         if not self.current_user:
             self.render('home.html', **kwargs)
         elif self.current_user['role'] == constants.ADMIN:
-            self.home_admin(**kwargs)
+            await self.home_admin(**kwargs)
         elif self.current_user['role'] == constants.STAFF:
-            self.home_staff(**kwargs)
+            await self.home_staff(**kwargs)
         else:
-            self.home_user(**kwargs)
+            await self.home_user(**kwargs)
 
-    def home_admin(self, **kwargs):
+    async def home_admin(self, **kwargs):
         "Home page for a current user having role 'admin'."
-        view = self.db.view('account/status',
-                            key=constants.PENDING,
-                            include_docs=True)
-        pending = [r.doc for r in view]
+        # XXX This status should not be hard-wired!
+        pending, view = await tornado.gen.multi([
+            self.async_db.view('account/status',
+                               key=constants.PENDING,
+                               include_docs=True),
+            self.async_db.view('order/status',
+                               descending=True,
+                               startkey=['submitted', constants.CEILING],
+                               endkey=['submitted'],
+                               limit=settings['DISPLAY_MAX_RECENT_ORDERS'],
+                               reduce=False)])
+        pending = [r.doc for r in pending]
         pending.sort(key=lambda i: i['modified'], reverse=True)
         pending = pending[:settings['DISPLAY_MAX_PENDING_ACCOUNTS']]
-        # XXX This status should not be hard-wired!
-        view = self.db.view('order/status',
-                            descending=True,
-                            startkey=['submitted', constants.CEILING],
-                            endkey=['submitted'],
-                            limit=settings['DISPLAY_MAX_RECENT_ORDERS'],
-                            reduce=False,
-                            include_docs=True)
-        orders = [r.doc for r in view]
+        orders = [r.value for r in view]
         self.render('home_admin.html',
                     pending=pending,
                     orders=orders,
                     **kwargs)
 
-    def home_staff(self, **kwargs):
+    async def home_staff(self, **kwargs):
         "Home page for a current user having role 'staff'."
         # XXX This status should not be hard-wired!
-        view = self.db.view('order/status',
-                            descending=True,
-                            startkey=['accepted', constants.CEILING],
-                            endkey=['accepted'],
-                            limit=settings['DISPLAY_MAX_RECENT_ORDERS'],
-                            reduce=False,
-                            include_docs=True)
-        orders = [r.doc for r in view]
+        view = await self.async_db.view(
+            'order/status',
+            descending=True,
+            startkey=['accepted', constants.CEILING],
+            endkey=['accepted'],
+            limit=settings['DISPLAY_MAX_RECENT_ORDERS'],
+            reduce=False)
+        orders = [r.value for r in view]
         self.render('home_staff.html',
                     orders=orders,
                     **kwargs)
 
-    def home_user(self, **kwargs):
+    async def home_user(self, **kwargs):
         "Home page for a current user having role 'user'."
-        view = self.db.view('order/owner',
-                            reduce=False,
-                            include_docs=True,
-                            descending=True,
-                            startkey=[self.current_user['email'],
-                                      constants.CEILING],
-                            endkey=[self.current_user['email']],
-                            limit=settings['DISPLAY_MAX_RECENT_ORDERS'])
-        orders = [r.doc for r in view]
+        view = await self.async_db.view(
+            'order/owner',
+            reduce=False,
+            descending=True,
+            startkey=[self.current_user['email'], constants.CEILING],
+            endkey=[self.current_user['email']],
+            limit=settings['DISPLAY_MAX_RECENT_ORDERS'])
+        orders = [r.value for r in view]
         self.render('home_user.html',
                     orders=orders,
                     **kwargs)
@@ -7,6 +7,7 @@ import logging
 import tornado.web
 
 import orderportal
+from orderportal import cache
 from orderportal import constants
 from orderportal import saver
 from orderportal import settings
@@ -17,6 +18,10 @@ from orderportal.requesthandler import RequestHandler
 class InfoSaver(saver.Saver):
     doctype = constants.INFO
 
+    def post_process(self):
+        "The info pages menu may have changed."
+        cache.reset_template_items()
+
 
 class Info(RequestHandler):
     "Information page."
@@ -39,6 +44,7 @@ class Info(RequestHandler):
         info = self.get_entity_view('info/name', name)
         self.delete_logs(info['_id'])
         self.db.delete(info)
+        cache.reset_template_items()
         self.see_other('infos')
 
 
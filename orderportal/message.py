@@ -4,6 +4,9 @@ import email.mime.text
 import logging
 import smtplib
 
+import couchdb
+import tornado.ioloop
+
 from orderportal import constants
 from orderportal import saver
 from orderportal import settings
@@ -27,48 +30,156 @@ class MessageSaver(saver.Saver):
         self['text'] = str(template['text']).format(**params)
 
     def send(self, recipients):
-        "Send the message to the given recipient email addresses."
+        """Queue the message for sending to the given recipient email
+        addresses. It is sent by the server in the background; see
+        'process_queue'. It is only recorded if no email server is set."""
+        self['recipients'] = recipients
+        if get_email_host():
+            self['queued'] = utils.timestamp()
+            self['attempts'] = 0
+
+    def log(self):
+        "Do not create any log entry; the message is its own log."
+        pass
+
+
+def get_email_host():
+    "Return the host name of the email server, or None if not set."
+    try:
+        return settings['EMAIL']['HOST']
+    except (KeyError, TypeError):
+        return None
+
+def get_email_server():
+    "Return a connection to the email server, logged in if required."
+    port = settings['EMAIL'].get('PORT', 0)
+    if settings['EMAIL'].get('SSL'):
+        server = smtplib.SMTP_SSL(get_email_host(), port=port)
+    else:
+        server = smtplib.SMTP(get_email_host(), port=port)
+        if settings['EMAIL'].get('TLS'):
+            server.starttls()
+    server.ehlo()
+    try:
+        user = settings['EMAIL']['USER']
+        password = settings['EMAIL']['PASSWORD']
+    except KeyError:
+        pass
+    else:
+        server.login(user, password)
+    return server
+
+def send_email(server, message):
+    "Send the message document by email using the server connection."
+    mail = email.mime.text.MIMEText(message['text'], 'plain', 'utf-8')
+    mail['Subject'] = message['subject']
+    mail['From'] = message['sender']
+    for recipient in message['recipients']:
+        mail['To'] = recipient
+    server.sendmail(message['sender'], message['recipients'], mail.as_string())
+
+def claim_queued(db):
+    """Return the queued messages due for sending, at most
+    MESSAGE_QUEUE_BATCH_SIZE. Each is claimed by setting its next attempt
+    to later, so that no other server process sends it concurrently."""
+    now = utils.timestamp()
+    view = db.view('message/queued',
+                   endkey=now,
+                   include_docs=True,
+                   limit=max(settings['MESSAGE_QUEUE_BATCH_SIZE'], 1))
+    result = []
+    for row in view:
+        message = row.doc
+        message['queued'] = utils.timestamp(
+            days=settings['MESSAGE_RETRY_DELAY'] / 86400.0)
         try:
-            self['recipients'] = recipients
-            try:
-                host = settings['EMAIL']['HOST']
-            except KeyError:
-                return
-            port = settings['EMAIL'].get('PORT', 0)
-            if settings['EMAIL'].get('SSL'):
-                server = smtplib.SMTP_SSL(host, port=port)
-            else:
-                server = smtplib.SMTP(host, port=port)
-                if settings['EMAIL'].get('TLS'):
-                    server.starttls()
-            server.ehlo()
-            try:
-                user = settings['EMAIL']['USER']
-                password = settings['EMAIL']['PASSWORD']
-            except KeyError:
-                pass
-            else:
-                server.login(user, password)
-            mail = email.mime.text.MIMEText(self['text'], 'plain', 'utf-8')
-            mail['Subject'] = self['subject']
-            mail['From'] = self['sender']
-            for recipient in self['recipients']:
-                mail['To'] = recipient
-            server.sendmail(self['sender'],
-                            self['recipients'],
-                            mail.as_string())
-            self['sent'] = utils.timestamp()
-        except Exception as msg:
-            self['error'] = str(msg)
-            logging.error("email failed to %s: %s", self['recipients'], msg)
-            raise
+            db.save(message)
+        except couchdb.ResourceConflict:
+            continue            # Claimed by another process.
+        result.append(message)
+    return result
 
-    def post_process(self):
+def send_queued(db):
+    """Send the queued messages that are due, using one connection to the
+    email server. A message that fails is retried after a delay, which
+    doubles for each attempt, until MESSAGE_MAX_ATTEMPTS have been made.
+    Return the number of messages sent."""
+    messages = claim_queued(db)
+    if not messages: return 0
+    count = 0
+    try:
+        server = get_email_server()
+    except Exception as msg:
+        server = None
+        error = str(msg)
+    for message in messages:
+        message['attempts'] = message.get('attempts', 0) + 1
+        try:
+            if server is None:
+                raise IOError(error)
+            send_email(server, message)
+        except Exception as msg:
+            message['error'] = str(msg)
+            logging.error("email failed to %s: %s", message['recipients'], msg)
+            if message['attempts'] >= settings['MESSAGE_MAX_ATTEMPTS']:
+                message.pop('queued')
+            else:
+                delay = settings['MESSAGE_RETRY_DELAY'] * \
+                        2 ** (message['attempts'] - 1)
+                message['queued'] = utils.timestamp(days=delay / 86400.0)
+        else:
+            message['sent'] = utils.timestamp()
+            message.pop('queued')
+            message.pop('error', None)
+            count += 1
+        message['modified'] = utils.timestamp()
+        save_outcome(db, message)
+    if server is not None:
         try:
-            self.server.quit()
-        except AttributeError:
+            server.quit()
+        except smtplib.SMTPException:
             pass
+    return count
 
-    def log(self):
-        "Do not create any log entry; the message is its own log."
-        pass
+def save_outcome(db, message):
+    """Save the outcome of the attempt to send the message. If the document
+    has been modified meanwhile, then the outcome is recorded in its current
+    revision. The failure to save is logged, so that the other messages are
+    still handled."""
+    try:
+        try:
+            db.save(message)
+        except couchdb.ResourceConflict:
+            current = db[message['_id']]
+            for key in ('sent', 'queued', 'attempts', 'error', 'modified'):
+                if key in message:
+                    current[key] = message[key]
+                else:
+                    current.pop(key, None)
+            db.save(current)
+    except (couchdb.http.HTTPError, IOError) as msg:
+        logging.error("could not save message %s (sent %s): %s",
+                      message['_id'], message.get('sent'), msg)
+
+# Is the queue being processed in the background?
+_processing = False
+# The database handle for the background thread; it has its own session.
+_queue_db = None
+
+async def process_queue():
+    """Send the queued messages in a background thread, so that the
+    server is not blocked by the exchange with the email server.
+    The thread uses a database handle of its own, since the handle of
+    the process is not thread-safe."""
+    global _processing, _queue_db
+    if _processing or not get_email_host(): return
+    _processing = True
+    try:
+        if _queue_db is None:
+            _queue_db = utils.create_db()
+        await tornado.ioloop.IOLoop.current().run_in_executor(
+            None, send_queued, _queue_db)
+    except (couchdb.http.HTTPError, IOError) as msg:
+        logging.error("could not process the message queue: %s", msg)
+    finally:
+        _processing = False
@@ -62,5 +62,5 @@ class NewsCreate(RequestHandler):
 class News(RequestHandler):
     "List all news items."
 
-    def get(self):
-        self.render('news.html', news_items=self.get_news())
+    async def get(self):
+        self.render('news.html', news_items=await self.get_news())
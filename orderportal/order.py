@@ -5,17 +5,21 @@ import logging
 import os.path
 import re
 import traceback
-import urllib.parse
 import zipfile
 from collections import OrderedDict as OD
 
 import couchdb
 import simplejson as json       # XXX Python 3 kludge
+import tornado.gen
 import tornado.web
+from tornado.escape import xhtml_escape as escape
 
+from . import cache
 from . import constants
 from . import saver
+from . import searchindex
 from . import settings
+from . import uimodules
 from . import utils
 from .fields import Fields
 from .message import MessageSaver
@@ -39,17 +43,22 @@ class OrderSaver(saver.Saver):
         self.files = []
         self.filenames = set(self.doc.get('_attachments', []))
         try:
-            self.fields = Fields(self.rqh.get_form(self.doc['form']))
+            self.fields = self.rqh.get_form_fields(self.doc['form'])
         except KeyError:
             pass
 
-    def create(self, form, title=None):
-        "Create the order from the given form."
-        self.fields = Fields(form)
+    def create(self, form, title=None, fields=None):
+        """Create the order from the given form.
+        The Fields object for the form may be given, if already set up.
+        The identifier must then be set by 'set_identifier'."""
+        self.fields = fields or Fields(form)
         self['form'] = form['_id']
         self['title'] = title
         self['fields'] = dict([(f['identifier'], None) for f in self.fields])
         self.set_status(settings['ORDER_STATUS_INITIAL']['identifier'])
+
+    async def set_identifier(self, form):
+        "Set the order identifier from the sequential counter, if required."
         # Set the order identifier if its format defined.
         # Allow also for disabled, since admin may clone such orders.
         if form['status'] in (constants.ENABLED, constants.DISABLED):
@@ -59,7 +68,7 @@ class OrderSaver(saver.Saver):
             except KeyError:    # No identifier; sequential counter not used
                 pass
             else:               # Identifier; sequential counter is used
-                counter = self.rqh.get_next_counter(constants.ORDER)
+                counter = await self.rqh.get_next_counter(constants.ORDER)
                 self['identifier'] = fmt.format(counter)
 
     def autopopulate(self):
@@ -232,8 +241,8 @@ class OrderSaver(saver.Saver):
                     value = self.rqh.get_arguments(identifier)
 
             elif field['type'] == constants.TABLE:
-                coldefs = [utils.parse_field_table_column(c) 
-                           for c in field['table']]
+                converters = self.fields.get_validator() \
+                                        .table_columns[identifier]
                 if data:        # JSON data: contains complete table.
                     try:
                         table = data[identifier]
@@ -248,7 +257,7 @@ class OrderSaver(saver.Saver):
                     table = []
                     for i in range(n_rows):
                         row = []
-                        for j, coldef in enumerate(coldefs):
+                        for j in range(len(converters)):
                             name = "_table_%s_%i_%i" % (identifier, i, j)
                             row.append(self.rqh.get_argument(name, None))
                         table.append(row)
@@ -257,21 +266,9 @@ class OrderSaver(saver.Saver):
                 try:
                     for row in table:
                         # Check correct number of items in the row.
-                        if len(row) != len(coldefs): continue
-                        for j, coldef in enumerate(coldefs):
-                            coltype = coldef.get('type')
-                            if coltype == constants.SELECT:
-                                if row[j] not in coldef['options']:
-                                    row[j] = None
-                                elif row[j] == '[no value]':
-                                    row[j] = None
-                            elif coltype == constants.INT:
-                                try:
-                                    row[j] = int(row[j])
-                                except (ValueError, TypeError):
-                                    row[j] = None
-                            elif not row[j]:
-                                row[j] = None
+                        if len(row) != len(converters): continue
+                        for j, convert in enumerate(converters):
+                            row[j] = convert(row[j])
                         # Use row only if first value is not None.
                         if row[0] is not None:
                             value.append(row)
@@ -300,112 +297,30 @@ class OrderSaver(saver.Saver):
                         else:
                             continue
                 # Remove all carriage-returns from string.
-                if value is not None:
+                if isinstance(value, str):
                     value = value.replace('\r', '')
             # Record any change to the value.
             if value != self.doc['fields'].get(identifier):
                 changed = self.changed.setdefault('fields', dict())
                 changed[identifier] = value
                 self.doc['fields'][identifier] = value
-        self.check_fields_validity()
+        # Check only the fields affected by the changes, if the validity
+        # of the order has been checked since the form was last modified.
+        if '_rev' in self.doc and 'invalid' in self.doc and \
+           self.doc.get('modified', '') >= self.fields.form.get('modified', ''):
+            self.fields.get_validator().revalidate(
+                self.doc['fields'],
+                self.doc['invalid'],
+                self.changed.get('fields', dict()))
+        else:
+            self.check_fields_validity()
 
     def check_fields_validity(self):
-        "Check validity of current field values."
-        self.doc['invalid'] = dict()
-        for field in self.fields:
-            if field['depth'] == 0:
-                self.check_validity(field)
-
-    def check_validity(self, field):
-        """Check validity of field value.
+        """Check validity of current field values.
         Also convert the value for some field types.
-        Skip field if not visible, else check recursively in postorder.
-        Return True if valid, False otherwise.
-        """
-        try:
-            select_id = field.get('visible_if_field')
-            if select_id:
-                select_value = self.doc['fields'].get(select_id)
-                if select_value is not None:
-                    select_value = str(select_value).lower()
-                if_value = field.get('visible_if_value')
-                if if_value:
-                    if_value = if_value.lower()
-                if select_value != if_value:
-                    return True
-
-            if field['type'] == constants.GROUP:
-                failure = False
-                for subfield in field['fields']:
-                    if not self.check_validity(subfield):
-                        failure = True
-                if failure:
-                    raise ValueError('subfield(s) invalid')
-            else:
-                value = self.doc['fields'][field['identifier']]
-                if value is None:
-                    if field['required']:
-                        raise ValueError('missing value')
-                elif field['type'] == constants.STRING:
-                    pass
-                elif field['type'] == constants.EMAIL:
-                    if not constants.EMAIL_RX.match(value):
-                        raise ValueError('not a valid email address')
-                elif field['type'] == constants.INT:
-                    try:
-                        self.doc['fields'][field['identifier']] = int(value)
-                    except (TypeError, ValueError):
-                        raise ValueError('not an integer value')
-                elif field['type'] == constants.FLOAT:
-                    try:
-                        self.doc['fields'][field['identifier']] = float(value)
-                    except (TypeError, ValueError):
-                        raise ValueError('not a float value')
-                elif field['type'] == constants.BOOLEAN:
-                    try:
-                        if value is None: raise ValueError
-                        self.doc['fields'][field['identifier']] = utils.to_bool(value)
-                    except (TypeError, ValueError):
-                        raise ValueError('not a boolean value')
-                elif field['type'] == constants.URL:
-                    parsed = urllib.parse.urlparse(value)
-                    if not (parsed.scheme and parsed.netloc):
-                        raise ValueError('incomplete URL')
-                elif field['type'] == constants.SELECT:
-                    if value not in field['select']:
-                        raise ValueError('value not among alternatives')
-                elif field['type'] == constants.MULTISELECT:
-                    if not isinstance(value, list):
-                        raise ValueError('value is not a list')
-                    if field['required'] and len(value) == 1 and value[0] == '':
-                        raise ValueError('missing value')
-                    for v in value:
-                        if v and v not in field['multiselect']:
-                            raise ValueError('value not among alternatives')
-                elif field['type'] == constants.TEXT:
-                    if not isinstance(value, str):
-                        raise ValueError('value is not a text string')
-                elif field['type'] == constants.DATE:
-                    if not constants.DATE_RX.match(value):
-                        raise ValueError('value is not a valid date')
-                elif field['type'] == constants.TABLE:
-                    if not isinstance(value, list):
-                        raise ValueError('table value is not a list')
-                    if field['required'] and len(value) == 0:
-                        raise ValueError('missing data')
-                    for r in value:
-                        if not isinstance(r, list):
-                            raise ValueError('table value is not a list of lists')
-                elif field['type'] == constants.FILE:
-                    pass
-        except ValueError as msg:
-            self.doc['invalid'][field['identifier']] = str(msg)
-            return False
-        except Exception as msg:
-            self.doc['invalid'][field['identifier']] = "System error: %s" % msg
-            return False
-        else:
-            return True
+        Fields which are not visible are skipped."""
+        self.doc['invalid'] = \
+            self.fields.get_validator().validate(self.doc['fields'])
 
     def set_history(self, history):
         "Set the history the JSON data (dict of status->date)"
@@ -421,6 +336,7 @@ class OrderSaver(saver.Saver):
 
     def post_process(self):
         self.modify_attachments()
+        searchindex.update_order(self.doc)
         if self.changed_status:
             self.send_message()
 
@@ -449,27 +365,10 @@ class OrderSaver(saver.Saver):
             template = settings['ORDER_MESSAGES'][self.doc['status']]
         except (couchdb.ResourceNotFound, KeyError):
             return
-        recipients = set()
-        owner = self.get_account(self.doc['owner'])
-        # Owner account may have been deleted.
-        if owner:
-            email = owner['email'].strip().lower()
-            if 'owner' in template['recipients']:
-                recipients = set([owner['email']])
-            if 'group' in template['recipients']:
-                for row in self.db.view('group/member',
-                                        include_docs=True,
-                                        key=email):
-                    for member in row.doc['members']:
-                        account = self.get_account(member)
-                        if account and account['status'] == constants.ENABLED:
-                            recipients.add(account['email'])
-        if constants.ADMIN in template['recipients']:
-            view = self.db.view('account/role', include_docs=True)
-            admins = [r.doc for r in view[constants.ADMIN]]
-            for admin in admins:
-                if admin['status'] == constants.ENABLED:
-                    recipients.add(admin['email'])
+        # Owner account may have been deleted; then only to admins.
+        recipients = cache.get_message_recipients(self.db,
+                                                  self.doc['owner'],
+                                                  template['recipients'])
         with MessageSaver(rqh=self) as saver:
             saver.create(template,
                          owner=self.doc['owner'],
@@ -477,7 +376,7 @@ class OrderSaver(saver.Saver):
                          identifier=self.doc.get('identifier') or self.doc['_id'],
                          url=self.get_order_url(self.doc),
                          tags=', '.join(self.doc.get('tags', [])))
-            saver.send(list(recipients))
+            saver.send(recipients)
 
     def get_order_url(self, order):
         """Member rqh is not available when used from a stand-alone script,
@@ -492,15 +391,6 @@ class OrderSaver(saver.Saver):
             path = settings['BASE_URL_PATH_PREFIX'] + path
         return settings['BASE_URL'] + path
 
-    def get_account(self, email):
-        "Get the account document for the given email."
-        view = self.db.view('account/email', include_docs=True)
-        rows = list(view[email])
-        if len(rows) == 1:
-            return rows[0].doc
-        else:
-            return None
-
 
 class OrderMixin(object):
     "Mixin for various useful methods."
@@ -508,22 +398,42 @@ class OrderMixin(object):
     def get_order(self, iuid):
         """Get the order for the identifier or IUID.
         Raise ValueError if no such order."""
+        identifier = self.get_order_identifier(iuid)
         try:
-            regexp = settings['ORDER_IDENTIFIER_REGEXP']
-            if not regexp: raise KeyError
-            match = re.match(regexp, iuid)
-            if not match: raise KeyError
-        except KeyError:
-            try:
-                order = self.get_entity(iuid, doctype=constants.ORDER)
-            except tornado.web.HTTPError:
-                raise ValueError('Sorry, no such order')
+            if identifier:
+                return self.get_entity_view('order/identifier', identifier)
+            else:
+                return self.get_entity(iuid, doctype=constants.ORDER)
+        except tornado.web.HTTPError:
+            raise ValueError('Sorry, no such order')
+
+    async def fetch_order(self, iuid):
+        """Get the order for the identifier or IUID without blocking.
+        Raise ValueError if no such order."""
+        identifier = self.get_order_identifier(iuid)
+        if identifier:
+            view = await self.async_db.view('order/identifier',
+                                            key=identifier,
+                                            include_docs=True)
+            if len(view) == 1:
+                return view[0].doc
         else:
             try:
-                order = self.get_entity_view('order/identifier', match.group())
-            except tornado.web.HTTPError:
-                raise ValueError('Sorry, no such order')
-        return order
+                order = await self.async_db.get(iuid)
+            except couchdb.ResourceNotFound:
+                pass
+            else:
+                if order.get(constants.DOCTYPE) == constants.ORDER:
+                    return order
+        raise ValueError('Sorry, no such order')
+
+    def get_order_identifier(self, iuid):
+        "Return the order identifier if the string matches its format."
+        regexp = settings.get('ORDER_IDENTIFIER_REGEXP')
+        if not regexp: return None
+        match = re.match(regexp, iuid)
+        if not match: return None
+        return match.group()
 
     def is_readable(self, order):
         "Is the order readable by the current user?"
@@ -581,13 +491,23 @@ class OrderMixin(object):
                              .format(utils.terminology('Order')))
 
     def get_form(self, iuid, check=False):
-        "Get the form given by its IUID. Optionally check that it is enabled."
-        form = self.get_entity(iuid, doctype=constants.FORM)
+        """Get the form given by its IUID. Optionally check that it is enabled.
+        The form is shared by the process, and must not be modified."""
+        try:
+            form = cache.get_form(self.db, iuid)[0]
+        except KeyError:
+            raise tornado.web.HTTPError(404, reason='Sorry, no such form.')
         if check:
             if form['status'] not in (constants.ENABLED, constants.TESTING):
                 raise ValueError('form is not available for creation')
         return form
 
+    def get_form_fields(self, iuid):
+        """Get the Fields object for the form given by its IUID.
+        It is shared by the process, and must not be modified."""
+        self.get_form(iuid)
+        return cache.get_form(self.db, iuid)[1]
+
     def get_fields(self, order, depth=0, fields=None):
         """Return a list of dictionaries, each of which
         for a field that is visible to the current user."""
@@ -664,6 +584,35 @@ class OrderMixin(object):
 class OrderApiV1Mixin(ApiV1Mixin):
     "Mixin for order JSON data structure."
 
+    def set_order_data(self, saver, data):
+        """Set the title, tags, external links, fields and history
+        of the order from the JSON data, when given."""
+        try:
+            saver['title'] = data['title']
+        except KeyError:
+            pass
+        try:
+            tags = data['tags']
+        except KeyError:
+            pass
+        else:
+            if isinstance(tags, str):
+                tags = [tags]
+            saver.set_tags(tags)
+        try:
+            saver.set_external(data['links']['external'])
+        except KeyError:
+            pass
+        try:
+            saver.update_fields(data=data['fields'])
+        except KeyError:
+            pass
+        if self.is_admin():
+            try:
+                saver.set_history(data['history'])
+            except KeyError:
+                pass
+
     def get_order_json(self, order, names={}, forms={}, full=False):
         """Return a dictionary for JSON output for the order.
         Account names or forms title lookup are computed if not given.
@@ -671,80 +620,107 @@ class OrderApiV1Mixin(ApiV1Mixin):
         NOTE: Only the values of the fields are included, not
         the full definition of the fields. To obtain that,
         one must fetch the JSON for the corresponding form."""
-        URL = self.absolute_reverse_url
+        return OrderJson(self, names=names, forms=forms)(order, full=full)
+
+
+class OrderJson(object):
+    """Produce the dictionary for JSON output for orders in one pass.
+    The URL formatters and the lookups are set up once, so that
+    one instance can be used efficiently for a list of orders."""
+
+    def __init__(self, rqh, names=None, forms=None):
+        """Account names or forms title lookup are computed
+        when needed, if not given."""
+        self.rqh = rqh
+        self.names = names
+        self.forms = forms
+        self.history_keys = [s['identifier']
+                             for s in settings['ORDER_STATUSES']]
+        URL = rqh.get_url_formatter
+        self.form_api_url = URL('form_api')
+        self.form_url = URL('form')
+        self.account_api_url = URL('account_api')
+        self.account_url = URL('account')
+        self.order_report_api_url = URL('order_report_api')
+        self.order_id_api_url = URL('order_id_api')
+        self.order_id_url = URL('order_id')
+        self.order_transition_api_url = URL('order_transition_api', 2)
+        self.order_file_url = URL('order_file', 2)
+
+    def __call__(self, order, full=False):
+        """Return the dictionary for the order.
+        If 'full' then add all fields, else only for orders list."""
+        try:
+            identifier = order['identifier']
+        except KeyError:
+            identifier = order['_id']
         if full:
-            data = utils.get_json(self.order_reverse_url(order, api=True),
-                                  'order')
+            data = dict(utils.get_json(self.order_id_api_url(identifier),
+                                       'order'))
         else:
-            data = OD()
+            data = dict()
         data['identifier'] = order.get('identifier')
         data['title'] = order.get('title') or '[no title]'
         data['iuid'] = order['_id']
         if full:
-            form = self.get_form(order['form'])
-            data['form'] = OD(
-                [('title', form['title']),
-                 ('version', form.get('version')),
-                 ('iuid', form['_id']),
-                 ('links', dict(api=dict(href=URL('form_api', form['_id'])),
-                                display=dict(href=URL('form', form['_id']))))])
+            form = self.rqh.get_form(order['form'])
+            data['form'] = {'title': form['title'],
+                            'version': form.get('version'),
+                            'iuid': form['_id'],
+                            'links': {
+                                'api': {'href': self.form_api_url(form['_id'])},
+                                'display': {'href':self.form_url(form['_id'])}}}
         else:
-            if not forms:
-                forms = self.get_forms_titles(all=True)
-            data['form'] = OD(
-                [('iuid', order['form']),
-                 ('title', forms[order['form']]),
-                 ('links', dict(api=dict(href=URL('form', order['form']))))])
-        if not names:
-            names = self.get_account_names([order['owner']])
-        data['owner'] = dict(
-            email=order['owner'],
-            name=names.get(order['owner']),
-            links=dict(api=dict(href=URL('account_api', order['owner'])),
-                       display=dict(href=URL('account', order['owner']))))
+            if not self.forms:
+                self.forms = self.rqh.get_forms_titles(all=True)
+            data['form'] = {'iuid': order['form'],
+                            'title': self.forms[order['form']],
+                            'links': {
+                                'api': {'href': self.form_url(order['form'])}}}
+        owner = order['owner']
+        names = self.names or self.rqh.get_account_names([owner])
+        data['owner'] = {'email': owner,
+                         'name': names.get(owner),
+                         'links': {
+                             'api': {'href': self.account_api_url(owner)},
+                             'display': {'href': self.account_url(owner)}}}
         data['status'] = order['status']
-        data['report'] = OD()
         if order.get('report'):
-            data['report']['content_type'] = order['_attachments'][constants.SYSTEM_REPORT]['content_type']
-            data['report']['timestamp'] = order['report']['timestamp']
-            data['report']['link'] = dict(href=URL('order_report_api',
-                                                   order['_id']))
-        data['history'] = OD()
-        for s in settings['ORDER_STATUSES']:
-            key = s['identifier']
-            data['history'][key] = order['history'].get(key)
-        data['tags'] = order.get('tags', [])
+            data['report'] = {
+                'content_type': order['_attachments'] \
+                                [constants.SYSTEM_REPORT]['content_type'],
+                'timestamp': order['report']['timestamp'],
+                'link': {'href': self.order_report_api_url(order['_id'])}}
+        else:
+            data['report'] = {}
+        history = order['history']
+        data['history'] = dict([(key, history.get(key))
+                                for key in self.history_keys])
+        data['tags'] = list(order.get('tags', []))
         data['modified'] = order['modified']
         data['created'] = order['created']
-        data['links'] = dict(
-            api=dict(href=self.order_reverse_url(order, api=True)),
-            display=dict(href=self.order_reverse_url(order)))
+        data['links'] = {'api': {'href': self.order_id_api_url(identifier)},
+                         'display': {'href': self.order_id_url(identifier)}}
         if full:
-            for status in self.get_targets(order):
-                data['links'][status['identifier']] = dict(
-                    href=URL('order_transition_api',
-                             order['_id'],
-                             status['identifier']),
-                    name='transition')
-            data['links']['external'] = order.get('links', {}).get('external', [])
-            data['fields'] = OD()
-            # A bit roundabout, but the fields will come out in correct order
-            for field in self.get_fields(order):
-                data['fields'][field['identifier']] = field['value']
-            data['invalid'] = order.get('invalid', {})
-            data['files'] = OD()
+            for status in self.rqh.get_targets(order):
+                data['links'][status['identifier']] = {
+                    'href': self.order_transition_api_url(order['_id'],
+                                                          status['identifier']),
+                    'name': 'transition'}
+            data['links']['external'] = \
+                list(order.get('links', {}).get('external', []))
+            data['fields'] = dict([(f['identifier'], f['value'])
+                                   for f in self.rqh.get_fields(order)])
+            data['invalid'] = dict(order.get('invalid', {}))
+            data['files'] = dict()
             for filename in sorted(order.get('_attachments', [])):
                 if filename.startswith(constants.SYSTEM): continue
                 stub = order['_attachments'][filename]
-                data['files'][filename] = dict(
-                    size=stub['length'],
-                    content_type=stub['content_type'],
-                    href=self.absolute_reverse_url('order_file',
-                                                   order['_id'],
-                                                   filename))
-        # XXX Terrible kludge! Converts binary keys and values to string.
-        # XXX A Python3 issue, possible due to bad old CouchDB interface.
-        return json.loads(json.dumps(data))
+                data['files'][filename] = {
+                    'size': stub['length'],
+                    'content_type': stub['content_type'],
+                    'href': self.order_file_url(order['_id'], filename)}
+        return data
 
 def convert_to_strings(doc):
     items = list(doc.items())
@@ -759,9 +735,9 @@ class Order(OrderMixin, RequestHandler):
     "Order page."
 
     @tornado.web.authenticated
-    def get(self, iuid):
+    async def get(self, iuid):
         try:
-            order = self.get_order(iuid)
+            order = await self.fetch_order(iuid)
         except ValueError as msg:
             self.see_other('home', error=str(msg))
             return
@@ -811,15 +787,16 @@ class Order(OrderMixin, RequestHandler):
             return
         self.delete_logs(order['_id'])
         self.db.delete(order)
+        searchindex.remove_order(order['_id'])
         self.see_other('orders')
 
 
 class OrderApiV1(OrderApiV1Mixin, OrderMixin, RequestHandler):
     "Order API; JSON output; JSON input for edit."
 
-    def get(self, iuid):
+    async def get(self, iuid):
         try:
-            order = self.get_order(iuid)
+            order = await self.fetch_order(iuid)
         except ValueError as msg:
             raise tornado.web.HTTPError(404, reason=str(msg))
         try:
@@ -840,31 +817,7 @@ class OrderApiV1(OrderApiV1Mixin, OrderMixin, RequestHandler):
         data = self.get_json_body()
         try:
             with OrderSaver(doc=order, rqh=self) as saver:
-                try:
-                    saver['title'] = data['title']
-                except KeyError:
-                    pass
-                try:
-                    tags = data['tags']
-                except KeyError:
-                    pass
-                else:
-                    if isinstance(tags, str):
-                        tags = [tags]
-                    saver.set_tags(tags)
-                try:
-                    saver.set_external(data['links']['external'])
-                except KeyError:
-                    pass
-                try:
-                    saver.update_fields(data=data['fields'])
-                except KeyError:
-                    pass
-                if self.is_admin():
-                    try:
-                        saver.set_history(data['history'])
-                    except KeyError:
-                        pass
+                self.set_order_data(saver, data)
         except ValueError as msg:
             raise tornado.web.HTTPError(400, reason=str(msg))
         else:
@@ -1012,7 +965,11 @@ class OrderZip(OrderApiV1Mixin, OrderCsv):
 
 
 class Orders(RequestHandler):
-    "Orders list page."
+    """Orders list page. The rows are fetched page by page
+    using the DataTables server-side processing protocol."""
+
+    # Only the order summaries are needed for the list.
+    full_orders = False
 
     @tornado.web.authenticated
     def get(self):
@@ -1020,28 +977,10 @@ class Orders(RequestHandler):
         if not self.is_staff():
             self.see_other('account_orders', self.current_user['email'])
             return
-        # Count of all orders
-        view = self.db.view('order/status', reduce=True)
-        try:
-            r = list(view)[0]
-        except IndexError:
-            all_count = 0
-        else:
-            all_count = r.value
-        # Initial ordering by the 'modified' column.
-        order_column = 5 + \
-                       int(settings['ORDERS_LIST_TAGS']) + \
-                       len(settings['ORDERS_LIST_FIELDS']) + \
-                       len(settings['ORDERS_LIST_STATUSES'])
         self.set_filter()
         self.render('orders.html',
-                    all_forms=self.get_forms_titles(all=True),
                     form_titles=sorted(self.get_forms_titles().values()),
-                    filter=self.filter,
-                    orders=self.get_orders(),
-                    order_column=order_column,
-                    account_names=self.get_account_names(),
-                    all_count=all_count)
+                    filter=self.filter)
 
     def set_filter(self):
         "Set the filter parameters dictionary."
@@ -1064,87 +1003,326 @@ class Orders(RequestHandler):
                 recent = True
         self.filter['recent'] = recent
 
-    def get_orders(self):
+    async def get_orders(self):
         "Get all orders according to current filter."
-        forms = self.get_forms_titles(all=True)
-        orders = self.filter_by_status(self.filter.get('status'))
-        orders = self.filter_by_forms(self.filter.get('form_title'),
-                                      forms=forms,
-                                      orders=orders)
-        for f in settings['ORDERS_LIST_FIELDS']:
-            orders = self.filter_by_field(f['identifier'],
-                                          self.filter.get(f['identifier']),
-                                          orders=orders)
-        try:
-            limit = settings['DISPLAY_ORDERS_MOST_RECENT']
-            if not isinstance(limit, int): raise ValueError
-        except (ValueError, KeyError):
-            limit = 0
+        orders = await self.filter_orders()
+        limit = self.get_recent_limit()
         # No filter; all orders
         if orders is None:
-            if limit > 0 and self.filter.get('recent', True):
-                view = self.db.view('order/modified',
-                                    include_docs=True,
-                                    descending=True,
-                                    limit=limit)
+            if limit > 0:
+                orders = await self.get_view_orders('order/modified',
+                                                    descending=True,
+                                                    limit=limit)
             else:
-                view = self.db.view('order/modified',
-                                    include_docs=True,
-                                    descending=True)
-            orders = [r.doc for r in view]
-        elif limit > 0 and self.filter.get('recent', True):
+                orders = await self.get_view_orders('order/modified',
+                                                    descending=True)
+        elif limit > 0:
             orders = orders[:limit]
         return orders
 
-    def filter_by_status(self, status, orders=None):
-        "Return orders list if any status filter, or None if none."
-        if status:
-            if orders is None:
-                view = self.db.view('order/status',
-                                    descending=True,
-                                    startkey=[status, constants.CEILING],
-                                    endkey=[status],
-                                    reduce=False,
-                                    include_docs=True)
-                orders = [r.doc for r in view]
-            else:
-                orders = [o for o in orders if o['status'] == status]
+    def get_recent_limit(self):
+        """Return the max number of most recent orders to get,
+        or 0 if no limit according to settings and current filter."""
+        if not self.filter.get('recent', True): return 0
+        try:
+            limit = settings['DISPLAY_ORDERS_MOST_RECENT']
+            if not isinstance(limit, int): raise ValueError
+        except (ValueError, KeyError):
+            limit = 0
+        return max(limit, 0)
+
+    async def get_orders_batches(self):
+        """Asynchronous generator of lists of orders according to current
+        filter, in descending order of modification. Only EXPORT_BATCH_SIZE
+        orders at a time are fetched when the filter is covered by
+        a single index."""
+        size = max(settings['EXPORT_BATCH_SIZE'], 1)
+        limit = self.get_recent_limit()
+        index = await self.get_filter_index()
+        page_view = self.get_page_view(index)
+        if page_view is None:
+            orders = await self.filter_orders(index)
+            orders.sort(key=lambda o: (o['modified'], o['_id']), reverse=True)
+            if limit > 0:
+                orders = orders[:limit]
+            for pos in range(0, len(orders), size):
+                yield orders[pos:pos+size]
+        else:
+            startkey = startkey_docid = None
+            while True:
+                if limit > 0:
+                    size = min(size, limit)
+                orders, next = await self.fetch_orders_page(
+                    page_view, size,
+                    startkey=startkey,
+                    startkey_docid=startkey_docid)
+                if orders:
+                    yield orders
+                if limit > 0:
+                    limit -= len(orders)
+                    if limit <= 0: break
+                if not next: break
+                startkey, startkey_docid = next
+
+    async def filter_orders(self, index=None):
+        """Return orders list according to current filter, or None if none.
+        The orders are fetched using the index with the fewest matching
+        orders, and then filtered by the remaining criteria.
+        The index is obtained if not given."""
+        if index is None:
+            index = await self.get_filter_index()
+        if index is None: return None
+        viewname, prefixes, count, covered = index
+        orders = []
+        for part in await tornado.gen.multi(
+                [self.get_view_orders(viewname,
+                                      descending=True,
+                                      startkey=prefix + [constants.CEILING],
+                                      endkey=prefix,
+                                      reduce=False)
+                 for prefix in prefixes]):
+            orders.extend(part)
+        status = self.filter.get('status')
+        if status and 'status' not in covered:
+            orders = [o for o in orders if o['status'] == status]
+        if self.filter.get('form_title') and 'form_title' not in covered:
+            forms = set(self.get_filter_forms())
+            orders = [o for o in orders if o['form'] in forms]
+        for f in settings['ORDERS_LIST_FIELDS']:
+            identifier = f['identifier']
+            value = self.filter.get(identifier)
+            if value and identifier not in covered:
+                if value == '__none__': value = None
+                orders = [o for o in orders
+                          if o['fields'].get(identifier) == value]
+        if len(prefixes) > 1:
+            orders.sort(key=lambda o: (o['modified'], o['_id']), reverse=True)
         return orders
 
-    def filter_by_forms(self, form_title, forms, orders=None):
-        "Return orders list if any form filter, or None if none."
-        if form_title:
-            forms = set([f[0] for f in list(forms.items()) if f[1] == form_title])
-            if orders is None:
-                orders = []
-                for form in forms:
-                    view = self.db.view('order/form',
-                                        descending=True,
-                                        reduce=False,
-                                        include_docs=True)
-                    orders.extend([r.doc for r in
-                                   view[[form, constants.CEILING]:[form]]])
+    async def get_filter_index(self):
+        """Return the index for the current filter as a tuple (view name,
+        list of key prefixes, count of matching orders, filter keys covered).
+        The index with the fewest matching orders is chosen.
+        Return None if no filter."""
+        candidates = []
+        status = self.filter.get('status')
+        if self.filter.get('form_title'):
+            forms = self.get_filter_forms()
+            if status:
+                candidates.append(('order/status_form',
+                                   [[status, f] for f in forms],
+                                   ('status', 'form_title')))
             else:
-                orders = [o for o in orders if o['form'] in forms]
-        return orders
-
-    def filter_by_field(self, identifier, value, orders=None):
-        "Return orders list if any field filter, or None if none."
-        if value:
-            if orders is None:
-                view = self.db.view('order/modified',
-                                    include_docs=True,
-                                    descending=True)
-                orders = [r.doc for r in view]
+                candidates.append(('order/form',
+                                   [[f] for f in forms],
+                                   ('form_title',)))
+        elif status:
+            candidates.append(('order/status', [[status]], ('status',)))
+        for f in settings['ORDERS_LIST_FIELDS']:
+            identifier = f['identifier']
+            value = self.filter.get(identifier)
+            if not value: continue
             if value == '__none__': value = None
-            orders = [o for o in orders if o['fields'].get(identifier) == value]
-        return orders
+            candidates.append(("list_fields/{0}".format(identifier),
+                               [[value]],
+                               (identifier,)))
+        if not candidates: return None
+        # The counts for all candidates are fetched concurrently.
+        views = await tornado.gen.multi(
+            [[self.async_db.view(viewname,
+                                 startkey=prefix,
+                                 endkey=prefix + [constants.CEILING],
+                                 reduce=True)
+              for prefix in prefixes]
+             for viewname, prefixes, covered in candidates])
+        result = []
+        for (viewname, prefixes, covered), prefix_views in zip(candidates,
+                                                              views):
+            count = sum([v[0].value for v in prefix_views if v])
+            result.append((viewname, prefixes, count, covered))
+        return min(result, key=lambda i: i[2])
+
+    def get_filter_forms(self):
+        "Return the IUIDs of the forms having the title in the filter."
+        form_title = self.filter.get('form_title')
+        forms = self.get_forms_titles(all=True)
+        return sorted([iuid for iuid, title in forms.items()
+                       if title == form_title])
+
+    async def get_orders_page(self, limit, startkey=None, startkey_docid=None,
+                              skip=0):
+        """Get a page of at most 'limit' orders according to current filter,
+        in descending order of modification. The page starts at the order
+        given by the cursor 'startkey' (modified) and 'startkey_docid' (IUID),
+        if given, else after skipping the given number of orders.
+        Return a tuple (orders, cursor for next page or None, total count)."""
+        index = await self.get_filter_index()
+        page_view = self.get_page_view(index)
+        # The index covers the filter; fetch the page from it.
+        if page_view:
+            orders, next = await self.fetch_orders_page(
+                page_view, limit,
+                startkey=startkey,
+                startkey_docid=startkey_docid,
+                skip=skip)
+            if index is None:
+                count = await self.get_orders_count()
+            else:
+                count = index[2]
+            return orders, next, count
+        # Additional filtering is required.
+        orders = await self.filter_orders(index)
+        orders.sort(key=lambda o: (o['modified'], o['_id']), reverse=True)
+        count = len(orders)
+        if startkey:
+            cursor = (startkey, startkey_docid or constants.CEILING)
+            orders = [o for o in orders if (o['modified'], o['_id']) <= cursor]
+        else:
+            orders = orders[skip:]
+        orders = orders[:limit+1]
+        if len(orders) > limit:
+            last = orders.pop()
+            return orders, (last['modified'], last['_id']), count
+        return orders, None, count
+
+    def get_page_view(self, index):
+        """Return the tuple (view name, key prefix) to fetch pages of orders
+        directly from, or None if the filter is not covered by the index.
+        The key prefix is None for the unfiltered 'order/modified' view."""
+        if index is None:
+            return ('order/modified', None)
+        viewname, prefixes, count, covered = index
+        filter_keys = set([k for k, v in self.filter.items()
+                           if v and k != 'recent'])
+        if len(prefixes) == 1 and filter_keys == set(covered):
+            return (viewname, prefixes[0])
+        return None
+
+    async def fetch_orders_page(self, page_view, limit, startkey=None,
+                                startkey_docid=None, skip=0):
+        """Fetch a page of at most 'limit' orders from the view.
+        Return a tuple (orders, cursor for next page or None)."""
+        viewname, prefix = page_view
+        kwargs = dict(descending=True, limit=limit+1)
+        if prefix is None:
+            if startkey:
+                kwargs['startkey'] = startkey
+        else:
+            kwargs['reduce'] = False
+            kwargs['startkey'] = prefix + [startkey or constants.CEILING]
+            kwargs['endkey'] = prefix
+        if startkey:
+            if startkey_docid:
+                kwargs['startkey_docid'] = startkey_docid
+        elif skip:
+            kwargs['skip'] = skip
+        orders = await self.get_view_orders(viewname, **kwargs)
+        if len(orders) > limit:
+            last = orders.pop()
+            return orders, (last['modified'], last['_id'])
+        return orders, None
+
+    async def get_view_orders(self, viewname, **kwargs):
+        """Return the orders for the rows of the view. Only the order
+        summaries, which are the values of the view, unless the full
+        documents are required."""
+        if self.full_orders:
+            view = await self.async_db.view(viewname,
+                                            include_docs=True,
+                                            **kwargs)
+            return [r.doc for r in view]
+        else:
+            view = await self.async_db.view(viewname, **kwargs)
+            return [r.value for r in view]
+
+    async def get_orders_count(self):
+        "Get the number of all orders."
+        view = await self.async_db.view('order/status', reduce=True)
+        try:
+            return view[0].value
+        except IndexError:
+            return 0
+
+    def get_page_arguments(self, default_limit=None):
+        """Get the paging arguments; limit, startkey, startkey_docid, skip.
+        Return None if no limit given and no default.
+        Raise HTTP Bad Request if any invalid value."""
+        try:
+            limit = int(self.get_argument('limit', default_limit))
+            skip = int(self.get_argument('skip', 0))
+            if limit <= 0 or skip < 0: raise ValueError
+        except TypeError:
+            return None
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='invalid paging argument')
+        return dict(limit=limit,
+                    startkey=self.get_argument('startkey', None),
+                    startkey_docid=self.get_argument('startkey_docid', None),
+                    skip=skip)
+
+
+class OrdersData(Orders):
+    """Orders list page rows; JSON output according to
+    the DataTables server-side processing protocol."""
+
+    @tornado.web.authenticated
+    async def get(self):
+        self.check_staff()
+        self.set_filter()
+        page = self.get_page_arguments(default_limit=25)
+        try:
+            page['skip'] = int(self.get_argument('start', 0) or 0)
+            if page['skip'] < 0: raise ValueError
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='invalid paging argument')
+        orders, next, count = await self.get_orders_page(**page)
+        names = self.get_account_names(set([o['owner'] for o in orders]))
+        forms = self.get_forms_titles(all=True)
+        entity = uimodules.Entity(self)
+        icon = uimodules.Icon(self)
+        tags = uimodules.Tags(self)
+        nonestr = uimodules.NoneStr(self)
+        data = []
+        for order in orders:
+            row = [entity.render(order, icon=False),
+                   escape(order.get('title') or '[no title]'),
+                   '<a href="%s">%s</a>' %
+                   (self.reverse_url('form', order['form']),
+                    escape(forms[order['form']])),
+                   '<a href="%s">%s</a>' %
+                   (self.reverse_url('account', order['owner']),
+                    escape(names[order['owner']]))]
+            if settings['ORDER_TAGS'] and settings['ORDERS_LIST_TAGS']:
+                row.append(tags.render(order.get('tags', [])))
+            for f in settings['ORDERS_LIST_FIELDS']:
+                row.append(escape(nonestr.render(
+                    order['fields'].get(f['identifier']))))
+            row.append(icon.render(order['status'], label=True))
+            for s in settings['ORDERS_LIST_STATUSES']:
+                row.append(nonestr.render(order['history'].get(s)))
+            row.append(order['modified'])
+            data.append(row)
+        result = dict(draw=int(self.get_argument('draw', 0) or 0),
+                      recordsTotal=await self.get_orders_count(),
+                      recordsFiltered=count,
+                      data=data)
+        if next:
+            result['next'] = dict(start=page['skip'] + len(orders),
+                                  startkey=next[0],
+                                  startkey_docid=next[1])
+        self.write(result)
 
 
 class OrdersApiV1(OrderApiV1Mixin, OrderMixin, Orders):
-    "Orders API; JSON output."
+    """Orders API; JSON output.
+    Paged if the argument 'limit' is given; the link 'next'
+    contains the cursor for the next page.
+    Streamed as newline-delimited JSON if requested, one order per line
+    after the first; the orders are then fetched and written in batches."""
 
-    def get(self):
+    full_orders = True
+
+    async def get(self):
         "JSON output."
         URL = self.absolute_reverse_url
         self.check_staff()
@@ -1153,31 +1331,67 @@ class OrdersApiV1(OrderApiV1Mixin, OrderMixin, Orders):
         result['filter'] = self.filter
         result['links'] = dict(api=dict(href=URL('orders_api')),
                                display=dict(href=URL('orders')))
+        if self.is_stream():
+            await self.write_orders_stream(result)
+            return
+        page = self.get_page_arguments()
+        if page is None:
+            orders = await self.get_orders()
+        else:
+            orders, next, count = await self.get_orders_page(**page)
+            result['total'] = count
+            if next:
+                result['links']['next'] = dict(
+                    href=URL('orders_api',
+                             limit=page['limit'],
+                             startkey=next[0],
+                             startkey_docid=next[1],
+                             **self.filter))
         # Get names and forms lookups once only
-        names = self.get_account_names()
+        names = self.get_account_names(set([o['owner'] for o in orders]))
         forms = self.get_forms_titles(all=True)
         result['items'] = []
         keys = [f['identifier'] for f in settings['ORDERS_LIST_FIELDS']]
-        for order in self.get_orders():
-            data = self.get_order_json(order, names, forms)
-            data['fields'] = OD()
-            for key in keys:
-                data['fields'][key] = order['fields'].get(key)
+        serializer = OrderJson(self, names=names, forms=forms)
+        for order in orders:
+            data = serializer(order)
+            data['fields'] = dict([(key, order['fields'].get(key))
+                                   for key in keys])
             result['items'].append(data)
             result['invalid'] = order['invalid']
         self.write(result)
 
+    async def write_orders_stream(self, result):
+        """Write the header and then the orders as newline-delimited JSON.
+        Paging is not used; the client is given the output of each batch
+        as soon as it is available."""
+        self.write_stream_start(result)
+        forms = self.get_forms_titles(all=True)
+        keys = [f['identifier'] for f in settings['ORDERS_LIST_FIELDS']]
+        async for orders in self.get_orders_batches():
+            names = self.get_account_names(set([o['owner'] for o in orders]))
+            serializer = OrderJson(self, names=names, forms=forms)
+            for order in orders:
+                data = serializer(order)
+                data['fields'] = dict([(key, order['fields'].get(key))
+                                       for key in keys])
+                self.write_stream_item(data)
+            await self.flush()
+
 
 class OrdersCsv(Orders):
-    "Orders list as CSV file."
+    """Orders list as CSV file.
+    The orders are fetched in batches, and the output is written
+    to the client as it is produced."""
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         # Ordinary users are not allowed to see the overall orders list.
         if not self.is_staff():
             self.see_other('account_orders', self.current_user['email'])
             return
         self.set_filter()
+        self.write_start()
         writer = self.get_writer()
         writer.writerow((settings['SITE_NAME'], utils.today()))
         row = ['Identifier', 'Title', 'IUID', 'URL', 
@@ -1188,34 +1402,39 @@ class OrdersCsv(Orders):
         row.extend([s.capitalize() for s in settings['ORDERS_LIST_STATUSES']])
         row.append('Modified')
         writer.writerow(row)
-        names = self.get_account_names()
         forms = self.get_forms_titles(all=True)
-        for order in self.get_orders():
-            row = [order.get('identifier') or '',
-                   order['title'] or '[no title]',
-                   order['_id'],
-                   self.order_reverse_url(order),
-                   forms[order['form']],
-                   order['form'],
-                   self.absolute_reverse_url('form', order['form']),
-                   order['owner'],
-                   names[order['owner']],
-                   self.absolute_reverse_url('account', order['owner']),
-                   ', '.join(order.get('tags', []))]
-            for f in settings['ORDERS_LIST_FIELDS']:
-                row.append(order['fields'].get(f['identifier']))
-            row.append(order['status'])
-            for s in settings['ORDERS_LIST_STATUSES']:
-                row.append(order['history'].get(s))
-            row.append(order['modified'])
-            writer.writerow(row)
-        self.write(writer.getvalue())
-        self.write_finish()
+        async for orders in self.get_orders_batches():
+            names = self.get_account_names(set([o['owner'] for o in orders]))
+            for order in orders:
+                self.write_order(writer, order, names, forms)
+            await self.write_writer(writer)
+        await self.write_writer(writer, close=True)
+
+    def write_order(self, writer, order, names, forms):
+        "Write the row for the order."
+        row = [order.get('identifier') or '',
+               order['title'] or '[no title]',
+               order['_id'],
+               self.order_reverse_url(order),
+               forms[order['form']],
+               order['form'],
+               self.absolute_reverse_url('form', order['form']),
+               order['owner'],
+               names[order['owner']],
+               self.absolute_reverse_url('account', order['owner']),
+               ', '.join(order.get('tags', []))]
+        for f in settings['ORDERS_LIST_FIELDS']:
+            row.append(order['fields'].get(f['identifier']))
+        row.append(order['status'])
+        for s in settings['ORDERS_LIST_STATUSES']:
+            row.append(order['history'].get(s))
+        row.append(order['modified'])
+        writer.writerow(row)
 
     def get_writer(self):
         return utils.CsvWriter()
 
-    def write_finish(self):
+    def write_start(self):
         self.set_header('Content-Type', constants.CSV_MIME)
         self.set_header('Content-Disposition', 
                         'attachment; filename="orders.csv"')
@@ -1225,9 +1444,9 @@ class OrdersXlsx(OrdersCsv):
     "Orders list as XLSX."
 
     def get_writer(self):
-        return utils.XlsxWriter()
+        return utils.XlsxWriter(constant_memory=True)
 
-    def write_finish(self):
+    def write_start(self):
         self.set_header('Content-Type', constants.XLSX_MIME)
         self.set_header('Content-Disposition', 
                         'attachment; filename="orders.xlsx"')
@@ -1274,12 +1493,13 @@ class OrderCreate(OrderMixin, RequestHandler):
             self.render('order_create.html', form=form)
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         try:
             self.check_creation_enabled()
             form = self.get_form(self.get_argument('form'), check=True)
             with OrderSaver(rqh=self) as saver:
-                saver.create(form)
+                saver.create(form, fields=self.get_form_fields(form['_id']))
+                await saver.set_identifier(form)
                 saver.autopopulate()
                 saver.check_fields_validity()
         except ValueError as msg:
@@ -1291,7 +1511,7 @@ class OrderCreate(OrderMixin, RequestHandler):
 class OrderCreateApiV1(OrderApiV1Mixin, OrderMixin, RequestHandler):
     "Create a new order by an API call."
 
-    def post(self):
+    async def post(self):
         "Form IUID and title in the JSON body of the request."
         try:
             self.check_login()
@@ -1304,7 +1524,10 @@ class OrderCreateApiV1(OrderApiV1Mixin, OrderMixin, RequestHandler):
             if not iuid: raise ValueError('no form IUID given')
             form = self.get_form(iuid, check=True)
             with OrderSaver(rqh=self) as saver:
-                saver.create(form, title=data.get('title'))
+                saver.create(form,
+                             title=data.get('title'),
+                             fields=self.get_form_fields(iuid))
+                await saver.set_identifier(form)
                 saver.autopopulate()
                 saver.check_fields_validity()
         except ValueError as msg:
@@ -1313,6 +1536,154 @@ class OrderCreateApiV1(OrderApiV1Mixin, OrderMixin, RequestHandler):
             self.write(self.get_order_json(saver.doc, full=True))
 
 
+class OrdersBulkApiV1(OrderApiV1Mixin, OrderMixin, RequestHandler):
+    """Create and edit orders in bulk by an API call.
+    The JSON body of the request is a list of items. An item containing
+    'iuid' (IUID or identifier) edits that order, else an order is created
+    from the form given by 'form'. The items may contain 'title', 'tags',
+    'links', 'fields' and 'history' as for a single order.
+    The orders and their log entries are saved using one request each.
+    The output contains the result for each item, in the same order."""
+
+    def prepare(self):
+        super(OrdersBulkApiV1, self).prepare()
+        self.counter_block = None
+
+    def get_form(self, iuid, check=False):
+        "Get the form given by its IUID. Raise ValueError if no such form."
+        try:
+            return super(OrdersBulkApiV1, self).get_form(iuid, check=check)
+        except tornado.web.HTTPError:
+            raise ValueError('no such form')
+
+    async def get_next_counter(self, doctype):
+        """Get the next counter number from a block reserved for
+        all orders created by this request that are valid."""
+        if self.counter_block is None or \
+           self.counter_block[0] > self.counter_block[1]:
+            self.counter_block = await utils.reserve_counter_block(
+                self.db, doctype, max(self.creations, 1))
+        number = self.counter_block[0]
+        self.counter_block[0] += 1
+        return number
+
+    def get_orders_lookup(self, keys):
+        """Get the orders given by IUID or identifier, using one request
+        for each kind of key. Return a lookup keyed by the given keys."""
+        result = dict()
+        for row in self.db.view('_all_docs', keys=keys, include_docs=True):
+            if row.doc and row.doc.get(constants.DOCTYPE) == constants.ORDER:
+                result[row.key] = row.doc
+        keys = [k for k in keys if k not in result]
+        if keys:
+            for row in self.db.view('order/identifier',
+                                    keys=keys,
+                                    include_docs=True):
+                result[row.key] = row.doc
+        return result
+
+    async def post(self):
+        self.check_login()
+        try:
+            items = self.get_json_body()
+            if not isinstance(items, list):
+                raise ValueError('JSON body is not a list')
+            for item in items:
+                if not isinstance(item, dict):
+                    raise ValueError('JSON list item is not a dictionary')
+        except ValueError as msg:
+            raise tornado.web.HTTPError(400, reason=str(msg))
+        orders = self.get_orders_lookup(
+            sorted(set([i['iuid'] for i in items if i.get('iuid')])))
+        results = []
+        savers = []
+        creations = []
+        edited = set()
+        for pos, item in enumerate(items):
+            result = OD(index=pos)
+            results.append(result)
+            try:
+                if item.get('iuid'):
+                    try:
+                        order = orders[item['iuid']]
+                    except KeyError:
+                        result['status'] = 404
+                        raise ValueError('Sorry, no such order')
+                    result['iuid'] = order['_id']
+                    if order['_id'] in edited:
+                        raise ValueError('order given more than once')
+                    edited.add(order['_id'])
+                    try:
+                        self.check_editable(order)
+                    except ValueError:
+                        result['status'] = 403
+                        raise
+                    saver = OrderSaver(doc=order, rqh=self)
+                    self.set_order_data(saver, item)
+                    result['status'] = 200
+                else:
+                    try:
+                        self.check_creation_enabled()
+                    except ValueError:
+                        result['status'] = 403
+                        raise
+                    iuid = item.get('form')
+                    if not iuid: raise ValueError('no form IUID given')
+                    form = self.get_form(iuid, check=True)
+                    saver = OrderSaver(rqh=self)
+                    saver.create(form,
+                                 title=item.get('title'),
+                                 fields=self.get_form_fields(iuid))
+                    saver.autopopulate()
+                    self.set_order_data(saver, item)
+                    if 'fields' not in item:
+                        saver.check_fields_validity()
+                    result['status'] = 201
+                saver.finalize()
+            except ValueError as msg:
+                if result.get('status') not in (403, 404):
+                    result['status'] = 400
+                result['reason'] = str(msg)
+            # Malformed item data, e.g. 'links' or 'fields' not a dictionary.
+            except (TypeError, AttributeError) as msg:
+                result['status'] = 400
+                result['reason'] = "invalid data: %s" % msg
+            else:
+                savers.append((saver, result))
+                if result['status'] == 201:
+                    creations.append((saver, form))
+        # Set the identifiers of the created orders only after validation,
+        # so that the invalid items do not leave gaps in the sequence.
+        self.creations = len(creations)
+        try:
+            for saver, form in creations:
+                await saver.set_identifier(form)
+        except ValueError as msg:
+            raise tornado.web.HTTPError(409, reason=str(msg))
+        # Save all orders, and then the log entries for those saved.
+        logs = []
+        if savers:
+            saved = self.db.update([saver.doc for saver, result in savers])
+            for (saver, result), (success, iuid, rev) in zip(savers, saved):
+                result['iuid'] = iuid
+                if success:
+                    result['identifier'] = saver.doc.get('identifier')
+                    result['links'] = dict(api=dict(
+                        href=self.order_reverse_url(saver.doc, api=True)))
+                    saver.post_process()
+                    logs.append(utils.get_log_entry(self, saver.doc,
+                                                    changed=saver.changed))
+                else:
+                    result['status'] = 409
+                    result['reason'] = 'document revision update conflict'
+        if logs:
+            self.db.update(logs)
+        data = utils.get_json(self.absolute_reverse_url('orders_bulk_api'),
+                              'orders bulk')
+        data['items'] = results
+        self.write(data)
+
+
 class OrderEdit(OrderMixin, RequestHandler):
     "Page for editing an order."
 
@@ -1326,7 +1697,7 @@ class OrderEdit(OrderMixin, RequestHandler):
             return
         colleagues = sorted(self.get_account_colleagues(self.current_user['email']))
         form = self.get_form(order['form'])
-        fields = Fields(form)
+        fields = self.get_form_fields(order['form'])
         if self.is_staff():
             tags = order.get('tags', [])
         else:
@@ -1436,7 +1807,7 @@ class OrderClone(OrderMixin, RequestHandler):
     "Create a new order from an existing one."
 
     @tornado.web.authenticated
-    def post(self, iuid):
+    async def post(self, iuid):
         order = self.get_entity(iuid, doctype=constants.ORDER)
         try:
             self.check_readable(order)
@@ -1449,8 +1820,11 @@ class OrderClone(OrderMixin, RequestHandler):
         form = self.get_form(order['form'])
         erased_files = set()
         with OrderSaver(rqh=self) as saver:
-            saver.create(form, title="Clone of {0}".format(
-                order['title'] or '[no title]'))
+            saver.create(form,
+                         title="Clone of {0}".format(
+                             order['title'] or '[no title]'),
+                         fields=self.get_form_fields(form['_id']))
+            await saver.set_identifier(form)
             for field in saver.fields:
                 id = field['identifier']
                 if field.get('erase_on_clone'):
@@ -1556,7 +1930,7 @@ class OrderFile(OrderMixin, RequestHandler):
             raise tornado.web.HTTPError(400, reason='Reserved filename.')
         order = self.get_entity(iuid, doctype=constants.ORDER)
         self.check_attachable(order)
-        fields = Fields(self.get_form(order['form']))
+        fields = self.get_form_fields(order['form'])
         with OrderSaver(doc=order, rqh=self) as saver:
             for key in order['fields']:
                 # Remove the field value if it is the filename.
@@ -8,11 +8,13 @@ import urllib.request, urllib.parse, urllib.error
 import urllib.parse
 
 import couchdb
-import markdown
 import simplejson as json       # XXX Python 3 kludge
+import tornado.escape
 import tornado.web
 
 import orderportal
+from . import asyncdb
+from . import cache
 from . import constants
 from . import settings
 from . import utils
@@ -22,13 +24,14 @@ class RequestHandler(tornado.web.RequestHandler):
     "Base request handler."
 
     def prepare(self):
-        "Get the database connection and global modes."
+        "Get the database connections and global modes."
         self.db = utils.get_db()
-        self.global_modes = constants.DEFAULT_GLOBAL_MODES.copy()
-        try:
-            self.global_modes.update(self.db['global_modes'])
-        except couchdb.ResourceNotFound:
-            pass
+        self.async_db = asyncdb.get_db()
+        self.global_modes = cache.get_global_modes(self.db)
+        # The groups graph, and the colleagues for each account;
+        # obtained when first needed, and then kept for the request.
+        self.groups_graph = None
+        self.colleagues = dict()
 
     def get_template_namespace(self):
         "Set the items accessible within the template."
@@ -47,13 +50,8 @@ class RequestHandler(tornado.web.RequestHandler):
         self.clear_cookie('error')
         result['message'] = self.get_cookie('message', '').replace('_', ' ')
         self.clear_cookie('message')
-        result['infos'] = [r.value for r in self.db.view('info/menu')]
-        try:
-            doc = self.get_entity_view('text/name', 'alert')
-        except tornado.web.HTTPError:
-            result['alert'] = None
-        else:
-            result['alert'] = markdown.markdown(doc['text'], output_format='html5')
+        result['infos'] = cache.get_infos_menu(self.db)
+        result['alert'] = cache.get_alert(self.db)
         result['reduce'] = functools.reduce
         return result
 
@@ -91,6 +89,27 @@ class RequestHandler(tornado.web.RequestHandler):
             url += '?' + urllib.parse.urlencode(query)
         return url
 
+    def get_url_formatter(self, name, count=1):
+        """Return a function producing the absolute URL for the handler name
+        given the arguments, as 'absolute_reverse_url' does, but without the
+        lookup of the handler for each call. For use in loops."""
+        markers = ["UrlArgument{0}Marker".format(i) for i in range(count)]
+        rest = self.absolute_reverse_url(name, *markers)
+        parts = []
+        for marker in markers:
+            part, rest = rest.split(marker, 1)
+            parts.append(part)
+        parts.append(rest)
+        def formatter(*args):
+            result = [parts[0]]
+            for arg, part in zip(args, parts[1:]):
+                if not isinstance(arg, str):
+                    arg = str(arg)
+                result.append(tornado.escape.url_escape(arg, plus=False))
+                result.append(part)
+            return ''.join(result)
+        return formatter
+
     def static_url(self, path, include_host=None, **kwargs):
         "Returns the URL for a static resource."
         url = super(RequestHandler, self).static_url(path,
@@ -161,10 +180,9 @@ class RequestHandler(tornado.web.RequestHandler):
         except KeyError:
             raise ValueError
         else:
-            try:
-                account = self.get_entity_view('account/api_key', api_key)
-            except tornado.web.HTTPError:
-                raise ValueError
+            account = cache.get_account(self.db, 'account/api_key',
+                                        api_key, 'api_key')
+            if account is None: raise ValueError
             logging.info("API key login: account %s", account['email'])
             return account
 
@@ -176,7 +194,11 @@ class RequestHandler(tornado.web.RequestHandler):
             constants.USER_COOKIE,
             max_age_days=settings['LOGIN_MAX_AGE_DAYS'])
         if not email: raise ValueError
-        account = self.get_account(email)
+        if isinstance(email, bytes):
+            email = email.decode()
+        account = cache.get_account(self.db, 'account/email',
+                                    email.strip().lower(), 'email')
+        if account is None: raise ValueError
         # Check if login session is invalidated.
         if account.get('login') is None: raise ValueError
         logging.info("Session authentication: %s", account['email'])
@@ -192,12 +214,14 @@ class RequestHandler(tornado.web.RequestHandler):
         except KeyError:
             raise ValueError
         try:
-            auth = auth.split()
-            if auth[0].lower() != 'basic': raise ValueError
-            auth = base64.b64decode(auth[1])
-            email, password = auth.split(':', 1)
-            account = self.get_account(email)
-            if utils.hashed_password(password) != account.get('password'):
+            parts = auth.split()
+            if parts[0].lower() != 'basic': raise ValueError
+            email, password = base64.b64decode(parts[1]).decode().split(':',1)
+            account = cache.get_account(self.db, 'account/email',
+                                        email.strip().lower(), 'email')
+            if account is None: raise ValueError
+            hashed = cache.get_basic_auth_hashed(auth, password)
+            if hashed != account.get('password'):
                 raise ValueError
         except (IndexError, ValueError, TypeError):
             raise ValueError
@@ -245,38 +269,14 @@ class RequestHandler(tornado.web.RequestHandler):
 
     def get_colleagues(self, email):
         "Get list of accounts in same groups as the account given by email."
-        colleagues = dict()
-        for row in self.db.view('group/member',
-                                include_docs=True,
-                                key=email.strip().lower()):
-            for member in row.doc['members']:
-                try:
-                    account = self.get_account(member)
-                except ValueError:
-                    pass
-                else:
-                    if account['status'] == constants.ENABLED:
-                        colleagues[account['email']] = account
-        return list(colleagues.values())
+        emails = sorted(self.get_account_colleagues(email))
+        if not emails: return []
+        view = self.db.view('account/email', keys=emails, include_docs=True)
+        return [r.doc for r in view if r.doc['status'] == constants.ENABLED]
 
-    def get_next_counter(self, doctype):
+    async def get_next_counter(self, doctype):
         "Get the next counter number for the doctype."
-        while True:
-            try:
-                doc = self.db[doctype] # Doc must be reloaded each iteration
-            except couchdb.ResourceNotFound:
-                doc = dict(_id=doctype)
-                doc[constants.DOCTYPE] = constants.META
-            try:
-                number = doc['counter'] + 1
-            except KeyError:
-                number = 1
-            doc['counter'] = number
-            try:
-                self.db.save(doc)
-                return number
-            except couchdb.ResourceConflict:
-                pass
+        return await utils.get_next_counter(self.db, doctype)
 
     def get_entity(self, iuid, doctype=None):
         """Get the entity by the IUID. Check the doctype, if given.
@@ -307,15 +307,15 @@ class RequestHandler(tornado.web.RequestHandler):
         else:
             raise tornado.web.HTTPError(404, reason=reason)
 
-    def get_news(self, limit=None):
+    async def get_news(self, limit=None):
         "Get all news items in descending 'modified' order."
         kwargs = dict(include_docs=True, descending=True)
         if limit is not None:
             kwargs['limit'] = limit
-        view = self.db.view('news/modified', **kwargs)
+        view = await self.async_db.view('news/modified', **kwargs)
         return [r.doc for r in view]
 
-    def get_events(self, upcoming=False):
+    async def get_events(self, upcoming=False):
         "Get all (descending) or upcoming (ascending) events."
         kwargs = dict(include_docs=True)
         if upcoming:
@@ -323,7 +323,7 @@ class RequestHandler(tornado.web.RequestHandler):
             kwargs['endkey'] = constants.CEILING
         else:
             kwargs['descending'] = True
-        view = self.db.view('event/date', **kwargs)
+        view = await self.async_db.view('event/date', **kwargs)
         return [r.doc for r in view]
 
     def get_entity_attachment_filename(self, entity):
@@ -368,52 +368,83 @@ class RequestHandler(tornado.web.RequestHandler):
         except IndexError:
             return 0
 
+    def get_groups_graph(self):
+        """Return the groups graph; see 'cache.get_groups_graph'.
+        It is obtained once per request."""
+        if self.groups_graph is None:
+            self.groups_graph = cache.get_groups_graph(self.db)
+        return self.groups_graph
+
     def get_account_groups(self, email):
         "Get sorted list of all groups which the account is a member of."
-        email = email.strip().lower()
-        view = self.db.view('group/member', include_docs=True)
-        return sorted([r.doc for r in view[email]],
-                      key=lambda i: i['name'])
+        groups, memberships = self.get_groups_graph()
+        return [groups[iuid]
+                for iuid in memberships.get(email.strip().lower(), [])]
 
     def get_account_colleagues(self, email):
         """Return the set of all emails for colleagues of the account;
         members of groups which the account is a member of."""
-        result = set()
-        for group in self.get_account_groups(email):
-            result.update(group['members'])
-        return result
+        email = email.strip().lower()
+        try:
+            return self.colleagues[email]
+        except KeyError:
+            result = set()
+            for group in self.get_account_groups(email):
+                result.update(group['members'])
+            self.colleagues[email] = result
+            return result
 
-    def get_invitations(self, email):
+    async def get_invitations(self, email):
         "Get the groups the account with the given email has been invited to."
-        view = self.db.view('group/invited', include_docs=True)
-        email = email.strip().lower()
-        return [r.doc for r in view[email]]
+        view = await self.async_db.view('group/invited',
+                                        key=email.strip().lower(),
+                                        include_docs=True)
+        return [r.doc for r in view]
 
     def is_colleague(self, email):
         """Is the user with the given email address
         in the same group as the current user?"""
-        if not self.current_user: return False
-        return self.current_user['email'] in self.get_account_colleagues(email)
+        return email.strip().lower() in self.get_current_colleagues()
+
+    def get_current_colleagues(self):
+        "Return the set of emails for the colleagues of the current user."
+        if not self.current_user: return set()
+        return self.get_account_colleagues(self.current_user['email'])
 
-    def get_account_names(self, emails=[]):
+    def get_account_names(self, emails=None):
         """Get dictionary with emails as key and names (last, first) as value.
+        The names are cached, and the missing ones fetched in one request.
         If emails is None, then for all accounts."""
+        if emails is not None:
+            return cache.get_account_names(self.db, emails)
         result = {}
-        view = self.db.view('account/email')
-        if emails:
-            for email in emails:
-                try:
-                    value = list(view[email.strip().lower()])[0].value
-                except IndexError:
-                    name = '[unknown]'
-                else:
-                    name = utils.get_account_name(value=value)
-                result[email] = name
-        else:
-            for row in view:
-                result[row.key] = utils.get_account_name(value=row.value)
+        for row in self.db.view('account/email'):
+            result[row.key] = utils.get_account_name(value=row.value)
         return result
 
+    async def write_writer(self, writer, close=False):
+        """Write the output available from the CSV or XLSX writer
+        to the client, waiting for it to be sent.
+        If 'close', then finish the file and write all of it."""
+        if close:
+            writer.close()
+        while True:
+            chunk = writer.pop()
+            if not chunk: break
+            self.write(chunk)
+            await self.flush()
+            if not close: break
+
+    async def get_order_summaries(self, iuids):
+        """Get the summaries of the orders given by IUID, in the same order.
+        A summary contains only the items shown in the orders lists;
+        see the view 'summary/order'. The order index views have the
+        summaries as values, so this is needed only when just the IUIDs
+        are known, as for the search hits."""
+        if not iuids: return []
+        view = await self.async_db.view('summary/order', keys=list(iuids))
+        return [r.value for r in view]
+
     def get_forms_titles(self, all=False):
         "Get form titles lookup for iuid, all or only the enabled+disabled."
         view = self.db.view('form/modified', include_docs=not all)
@@ -426,6 +457,7 @@ class RequestHandler(tornado.web.RequestHandler):
 
     def get_logs(self, iuid, limit=settings['DISPLAY_DEFAULT_MAX_LOG']+1):
         "Return the event log documents for the given entity iuid."
+        utils.flush_log()
         kwargs = dict(include_docs=True,
                       startkey=[iuid, constants.CEILING],
                       endkey=[iuid],
@@ -444,6 +476,7 @@ class RequestHandler(tornado.web.RequestHandler):
 
     def delete_logs(self, iuid):
         "Delete the event log documents for the given entity iuid."
+        utils.flush_log()
         view = self.db.view('log/entity',
                             startkey=[iuid],
                             endkey=[iuid, constants.CEILING])
@@ -470,3 +503,24 @@ class ApiV1Mixin(object):
     def check_xsrf_cookie(self):
         "Do not check for XSRF cookie when API."
         pass
+
+    def is_stream(self):
+        """Is the output to be streamed as newline-delimited JSON?
+        Requested by the Accept header, or by the argument 'stream'."""
+        if constants.NDJSON_MIME in self.request.headers.get('Accept', ''):
+            return True
+        try:
+            return utils.to_bool(self.get_argument('stream', False))
+        except ValueError:
+            return False
+
+    def write_stream_start(self, data):
+        """Set the content type for newline-delimited JSON,
+        and write the data as the first line."""
+        self.set_header('Content-Type', constants.NDJSON_MIME)
+        self.write_stream_item(data)
+
+    def write_stream_item(self, data):
+        "Write the data as one line of newline-delimited JSON."
+        self.write(tornado.escape.json_encode(data))
+        self.write('\n')
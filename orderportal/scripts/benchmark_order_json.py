@@ -0,0 +1,214 @@
+"""OrderPortal: Benchmark the production of JSON output for orders.
+The OrderJson serializer is compared with the previous implementation,
+which built OrderedDicts and converted them by a JSON round trip.
+The output is checked to be identical, both for the orders list and for
+the full order, including fields, files, transitions and external links.
+No database is required.
+"""
+
+import optparse
+import timeit
+from collections import OrderedDict as OD
+
+import simplejson as json
+import tornado.escape
+import tornado.httputil
+import tornado.web
+import yaml
+
+from orderportal import constants
+from orderportal import settings
+from orderportal import utils
+from orderportal.order import OrderApiV1Mixin, OrderJson, OrderMixin
+from orderportal.requesthandler import RequestHandler
+
+
+class Handler(OrderApiV1Mixin, OrderMixin, RequestHandler):
+    """Request handler outside of a request, for the URLs.
+    The form and the transitions are synthetic, instead of from the
+    database and the current user."""
+
+    def get_current_user(self):
+        return None
+
+    def get_form(self, iuid, check=False):
+        return dict(_id=iuid, title='Form title', version='1.0')
+
+    def get_fields(self, order, depth=0, fields=None):
+        return [OD(identifier=k, value=v)
+                for k, v in sorted(order['fields'].items())]
+
+    def get_targets(self, order):
+        return settings['ORDER_STATUSES'][1:3]
+
+
+class Connection(object):
+    "Placeholder for the HTTP connection of the request."
+
+    def set_close_callback(self, callback):
+        pass
+
+
+def get_handler():
+    "Return a handler instance for an application with the required URLs."
+    url = tornado.web.url
+    application = tornado.web.Application([
+        url(r'/order/([^/]+)', Handler, name='order_id'),
+        url(r'/api/v1/order/([^/]+)', Handler, name='order_id_api'),
+        url(r'/api/v1/order/([0-9a-f]{32})/transition/(\w+)',
+            Handler, name='order_transition_api'),
+        url(r'/order/([0-9a-f]{32})/file/([^/]+)', Handler, name='order_file'),
+        url(r'/api/v1/order/([0-9a-f]{32})/report',
+            Handler, name='order_report_api'),
+        url(r'/account/([^/]+)', Handler, name='account'),
+        url(r'/api/v1/account/([^/]+)', Handler, name='account_api'),
+        url(r'/form/([0-9a-f]{32})', Handler, name='form'),
+        url(r'/api/v1/form/([0-9a-f]{32})', Handler, name='form_api')])
+    request = tornado.httputil.HTTPServerRequest(method='GET', uri='/')
+    request.connection = Connection()
+    return Handler(application, request)
+
+def get_orders(count):
+    "Return the given number of synthetic order documents."
+    result = []
+    statuses = [s['identifier'] for s in settings['ORDER_STATUSES']]
+    for i in range(count):
+        order = dict(_id=utils.get_iuid(),
+                     identifier="ORD{0:05d}".format(i),
+                     title="Order number {0}".format(i),
+                     form=utils.get_iuid(),
+                     owner="user{0}@example.com".format(i % 50),
+                     status=statuses[i % len(statuses)],
+                     history=dict([(s, '2020-01-01') for s in statuses[:3]]),
+                     tags=['tag1', 'tag2'],
+                     fields=dict(a=i, b='some text', c=None,
+                                 d=['x', 'y'], e=[['row', 1]]),
+                     invalid=dict(c='missing value'),
+                     links=dict(external=[dict(href='https://example.com/',
+                                               title='Example')]),
+                     modified=utils.timestamp(),
+                     created=utils.timestamp())
+        order['_attachments'] = {"file {0}.txt".format(i):
+                                 dict(content_type='text/plain', length=i)}
+        if i % 3 == 0:
+            order['report'] = dict(timestamp=utils.timestamp())
+            order['_attachments'][constants.SYSTEM_REPORT] = \
+                dict(content_type='text/html', length=100)
+        if i % 2:
+            order.pop('identifier')
+            order['links'] = dict()
+        result.append(order)
+    return result
+
+def get_order_json_previous(rqh, order, names, forms, full=False):
+    "The previous implementation, for comparison."
+    URL = rqh.absolute_reverse_url
+    if full:
+        data = utils.get_json(rqh.order_reverse_url(order, api=True), 'order')
+    else:
+        data = OD()
+    data['identifier'] = order.get('identifier')
+    data['title'] = order.get('title') or '[no title]'
+    data['iuid'] = order['_id']
+    if full:
+        form = rqh.get_form(order['form'])
+        data['form'] = OD(
+            [('title', form['title']),
+             ('version', form.get('version')),
+             ('iuid', form['_id']),
+             ('links', dict(api=dict(href=URL('form_api', form['_id'])),
+                            display=dict(href=URL('form', form['_id']))))])
+    else:
+        data['form'] = OD(
+            [('iuid', order['form']),
+             ('title', forms[order['form']]),
+             ('links', dict(api=dict(href=URL('form', order['form']))))])
+    data['owner'] = dict(
+        email=order['owner'],
+        name=names.get(order['owner']),
+        links=dict(api=dict(href=URL('account_api', order['owner'])),
+                   display=dict(href=URL('account', order['owner']))))
+    data['status'] = order['status']
+    data['report'] = OD()
+    if order.get('report'):
+        data['report']['content_type'] = order['_attachments'][constants.SYSTEM_REPORT]['content_type']
+        data['report']['timestamp'] = order['report']['timestamp']
+        data['report']['link'] = dict(href=URL('order_report_api',
+                                               order['_id']))
+    data['history'] = OD()
+    for s in settings['ORDER_STATUSES']:
+        key = s['identifier']
+        data['history'][key] = order['history'].get(key)
+    data['tags'] = order.get('tags', [])
+    data['modified'] = order['modified']
+    data['created'] = order['created']
+    data['links'] = dict(
+        api=dict(href=rqh.order_reverse_url(order, api=True)),
+        display=dict(href=rqh.order_reverse_url(order)))
+    if full:
+        for status in rqh.get_targets(order):
+            data['links'][status['identifier']] = dict(
+                href=URL('order_transition_api',
+                         order['_id'],
+                         status['identifier']),
+                name='transition')
+        data['links']['external'] = order.get('links', {}).get('external', [])
+        data['fields'] = OD()
+        for field in rqh.get_fields(order):
+            data['fields'][field['identifier']] = field['value']
+        data['invalid'] = order.get('invalid', {})
+        data['files'] = OD()
+        for filename in sorted(order.get('_attachments', [])):
+            if filename.startswith(constants.SYSTEM): continue
+            stub = order['_attachments'][filename]
+            data['files'][filename] = dict(
+                size=stub['length'],
+                content_type=stub['content_type'],
+                href=rqh.absolute_reverse_url('order_file',
+                                              order['_id'],
+                                              filename))
+    return json.loads(json.dumps(data))
+
+def get_output(orders):
+    """Return the JSON text for the list of order outputs. The timestamp
+    of the output for a full order is removed, since it differs."""
+    for order in orders:
+        order.pop('timestamp', None)
+    return tornado.escape.json_encode(orders)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options]',
+                                   description='Benchmark order JSON output.')
+    parser.add_option('-n', '--number',
+                      action='store', type='int', dest='number', default=10000,
+                      help='number of orders (default 10000)')
+    (options, args) = parser.parse_args()
+    with open(utils.expand_filepath(settings['ORDER_STATUSES_FILEPATH'])) as infile:
+        settings['ORDER_STATUSES'] = yaml.safe_load(infile)
+    rqh = get_handler()
+    orders = get_orders(options.number)
+    names = dict([(o['owner'], 'Name, Some') for o in orders])
+    forms = dict([(o['form'], 'Form title') for o in orders])
+
+    for full in (False, True):
+
+        def previous():
+            return [get_order_json_previous(rqh, o, names, forms, full=full)
+                    for o in orders]
+
+        def serializer():
+            serializer = OrderJson(rqh, names=names, forms=forms)
+            return [serializer(o, full=full) for o in orders]
+
+        assert get_output(previous()) == get_output(serializer()), \
+            "different output, full={0}".format(full)
+        print("{0} orders, {1}.".format(options.number,
+                                        full and 'full' or 'list'))
+        previous = min(timeit.repeat(previous, number=1, repeat=3))
+        print("Previous:   {0:.3f} s, {1:.0f} orders/s".format(
+            previous, options.number / previous))
+        serializer = min(timeit.repeat(serializer, number=1, repeat=3))
+        print("Serializer: {0:.3f} s, {1:.0f} orders/s".format(
+            serializer, options.number / serializer))
+        print("Speed-up: {0:.1f}x".format(previous / serializer))
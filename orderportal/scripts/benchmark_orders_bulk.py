@@ -0,0 +1,73 @@
+"""OrderPortal: Benchmark the creation of orders in bulk by the API.
+The time to create a number of orders by one API call each is compared
+with the time to create the same number of orders by one bulk API call.
+
+NOTE: This requires a running OrderPortal instance, and it creates real
+orders in its database. Do not use it against a production instance.
+
+NOTE: This uses the third-party 'requests' module.
+"""
+
+import optparse
+import time
+
+# Third-party package: http://docs.python-requests.org/en/master/
+import requests
+
+
+def get_item(form, number):
+    "Get the data for an order to create."
+    return {'title': "Bulk benchmark order %i" % number, 'form': form}
+
+def create_single(session, base, form, number):
+    "Create the orders by one API call each."
+    url = "{base}/api/v1/order".format(base=base)
+    for i in range(number):
+        response = session.post(url, json=get_item(form, i))
+        assert response.status_code == 200, \
+            (response.status_code, response.reason)
+
+def create_bulk(session, base, form, number):
+    "Create the orders by one bulk API call."
+    url = "{base}/api/v1/orders/bulk".format(base=base)
+    response = session.post(url,
+                            json=[get_item(form, i) for i in range(number)])
+    assert response.status_code == 200, (response.status_code, response.reason)
+    for item in response.json()['items']:
+        assert item['status'] == 201, item
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(
+        usage='usage: %prog [options]',
+        description='Benchmark bulk order creation using a running instance.')
+    parser.add_option('-u', '--url',
+                      action='store', dest='url',
+                      default='http://localhost:8886',
+                      help='base URL of the instance (default localhost:8886)')
+    parser.add_option('-k', '--key',
+                      action='store', dest='key',
+                      help='API key for the user account')
+    parser.add_option('-f', '--form',
+                      action='store', dest='form',
+                      help='IUID of the form to create orders from')
+    parser.add_option('-n', '--number',
+                      action='store', type='int', dest='number', default=500,
+                      help='number of orders to create each way (default 500)')
+    (options, args) = parser.parse_args()
+    if not (options.key and options.form):
+        parser.error('API key and form IUID must be given')
+    session = requests.Session()
+    session.headers['X-OrderPortal-API-key'] = options.key
+    print("{0} orders created each way.".format(options.number))
+    start = time.perf_counter()
+    create_single(session, options.url, options.form, options.number)
+    single = time.perf_counter() - start
+    print("Single API calls: {0:.2f} s ({1:.0f} orders/s)".format(
+        single, options.number / single))
+    start = time.perf_counter()
+    create_bulk(session, options.url, options.form, options.number)
+    bulk = time.perf_counter() - start
+    print("Bulk API call:    {0:.2f} s ({1:.0f} orders/s)".format(
+        bulk, options.number / bulk))
+    print("Speed-up: {0:.1f}x".format(single / bulk))
@@ -0,0 +1,193 @@
+"""OrderPortal: Benchmark the checking of the field values of an order.
+The compiled validation program is compared with the previous recursive
+check of the form tree, using a synthetic form with many fields.
+No database is required.
+"""
+
+import copy
+import optparse
+import timeit
+import urllib.parse
+
+from orderportal import constants
+from orderportal import utils
+from orderportal.fields import Fields
+
+
+def get_form(n_groups, n_fields):
+    "Create a form with the given number of groups, each with fields."
+    types = [constants.STRING, constants.EMAIL, constants.INT,
+             constants.FLOAT, constants.BOOLEAN, constants.URL,
+             constants.SELECT, constants.MULTISELECT, constants.TEXT,
+             constants.DATE, constants.TABLE]
+    form = dict(fields=[])
+    for g in range(n_groups):
+        group = dict(identifier="group%i" % g, type=constants.GROUP,
+                     required=False, fields=[])
+        # Every other group is visible only if a boolean field is set.
+        if g % 2:
+            group['visible_if_field'] = "field%i_%i" % (g-1, 4)
+            group['visible_if_value'] = 'True'
+        for f in range(n_fields):
+            field = dict(identifier="field%i_%i" % (g, f),
+                         type=types[f % len(types)],
+                         required=bool(f % 3))
+            if field['type'] == constants.SELECT:
+                field['select'] = ["choice %i" % i for i in range(20)]
+            elif field['type'] == constants.MULTISELECT:
+                field['multiselect'] = ["choice %i" % i for i in range(20)]
+            elif field['type'] == constants.TABLE:
+                field['table'] = ['name', 'count;int', 'kind;select;a|b|c']
+            group['fields'].append(field)
+        form['fields'].append(group)
+    return form
+
+def get_values(fields):
+    "Create field values for the form; some are invalid."
+    values = {constants.STRING: 'a string',
+              constants.EMAIL: 'someone@example.com',
+              constants.INT: '42',
+              constants.FLOAT: 'not a number',
+              constants.BOOLEAN: 'true',
+              constants.URL: 'https://example.com/',
+              constants.SELECT: 'choice 19',
+              constants.MULTISELECT: ['choice 1', 'choice 19'],
+              constants.TEXT: 'Some text.',
+              constants.DATE: '2020-01-01',
+              constants.TABLE: [['x', 1, 'a'], ['y', 2, 'b']]}
+    result = dict()
+    for field in fields:
+        if field['type'] == constants.GROUP: continue
+        if field['required'] or len(result) % 5:
+            value = copy.deepcopy(values[field['type']])
+            # Some required tables are empty, and some dates are not
+            # strings, which gives a system error.
+            if len(result) % 2:
+                if field['type'] == constants.TABLE and field['required']:
+                    value = []
+                elif field['type'] == constants.DATE:
+                    value = 20200101
+            result[field['identifier']] = value
+        else:
+            result[field['identifier']] = None
+    return result
+
+def check_recursive(fields, values):
+    "The previous recursive check of the form tree, for comparison."
+    invalid = dict()
+    def check(field):
+        try:
+            select_id = field.get('visible_if_field')
+            if select_id:
+                select_value = values.get(select_id)
+                if select_value is not None:
+                    select_value = str(select_value).lower()
+                if_value = field.get('visible_if_value')
+                if if_value:
+                    if_value = if_value.lower()
+                if select_value != if_value:
+                    return True
+
+            if field['type'] == constants.GROUP:
+                failure = False
+                for subfield in field['fields']:
+                    if not check(subfield):
+                        failure = True
+                if failure:
+                    raise ValueError('subfield(s) invalid')
+            else:
+                value = values[field['identifier']]
+                if value is None:
+                    if field['required']:
+                        raise ValueError('missing value')
+                elif field['type'] == constants.STRING:
+                    pass
+                elif field['type'] == constants.EMAIL:
+                    if not constants.EMAIL_RX.match(value):
+                        raise ValueError('not a valid email address')
+                elif field['type'] == constants.INT:
+                    try:
+                        values[field['identifier']] = int(value)
+                    except (TypeError, ValueError):
+                        raise ValueError('not an integer value')
+                elif field['type'] == constants.FLOAT:
+                    try:
+                        values[field['identifier']] = float(value)
+                    except (TypeError, ValueError):
+                        raise ValueError('not a float value')
+                elif field['type'] == constants.BOOLEAN:
+                    try:
+                        if value is None: raise ValueError
+                        values[field['identifier']] = utils.to_bool(value)
+                    except (TypeError, ValueError):
+                        raise ValueError('not a boolean value')
+                elif field['type'] == constants.URL:
+                    parsed = urllib.parse.urlparse(value)
+                    if not (parsed.scheme and parsed.netloc):
+                        raise ValueError('incomplete URL')
+                elif field['type'] == constants.SELECT:
+                    if value not in field['select']:
+                        raise ValueError('value not among alternatives')
+                elif field['type'] == constants.MULTISELECT:
+                    if not isinstance(value, list):
+                        raise ValueError('value is not a list')
+                    if field['required'] and len(value) == 1 and value[0] == '':
+                        raise ValueError('missing value')
+                    for v in value:
+                        if v and v not in field['multiselect']:
+                            raise ValueError('value not among alternatives')
+                elif field['type'] == constants.TEXT:
+                    if not isinstance(value, str):
+                        raise ValueError('value is not a text string')
+                elif field['type'] == constants.DATE:
+                    if not constants.DATE_RX.match(value):
+                        raise ValueError('value is not a valid date')
+                elif field['type'] == constants.TABLE:
+                    if not isinstance(value, list):
+                        raise ValueError('table value is not a list')
+                    if field['required'] and len(value) == 0:
+                        raise ValueError('missing data')
+                    for r in value:
+                        if not isinstance(r, list):
+                            raise ValueError('table value is not a list of lists')
+                elif field['type'] == constants.FILE:
+                    pass
+        except ValueError as msg:
+            invalid[field['identifier']] = str(msg)
+            return False
+        except Exception as msg:
+            invalid[field['identifier']] = "System error: %s" % msg
+            return False
+        else:
+            return True
+    for field in fields.form['fields']:
+        check(field)
+    return invalid
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options]',
+                                   description='Benchmark field validation.')
+    parser.add_option('-g', '--groups',
+                      action='store', type='int', dest='groups', default=20,
+                      help='number of groups in the form (default 20)')
+    parser.add_option('-f', '--fields',
+                      action='store', type='int', dest='fields', default=25,
+                      help='number of fields per group (default 25)')
+    parser.add_option('-n', '--number',
+                      action='store', type='int', dest='number', default=200,
+                      help='number of validations to time (default 200)')
+    (options, args) = parser.parse_args()
+    fields = Fields(get_form(options.groups, options.fields))
+    values = get_values(fields)
+    validator = fields.get_validator()
+    assert validator.validate(dict(values)) == \
+        check_recursive(fields, dict(values)), 'different results'
+    print("Form with {0} fields, {1} validations.".format(
+        len(fields._lookup), options.number))
+    recursive = timeit.timeit(lambda: check_recursive(fields, dict(values)),
+                              number=options.number)
+    print("Recursive check: {0:.4f} s".format(recursive))
+    compiled = timeit.timeit(lambda: validator.validate(dict(values)),
+                             number=options.number)
+    print("Compiled check:  {0:.4f} s".format(compiled))
+    print("Speed-up: {0:.1f}x".format(recursive / compiled))
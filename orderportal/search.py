@@ -3,106 +3,51 @@
 
 
 import logging
-import pprint
-import urllib.parse
 
-import couchdb
 import tornado.web
 
-from . import constants
-from . import saver
+from . import searchindex
 from . import settings
-from . import utils
-from .fields import Fields
 from .requesthandler import RequestHandler
-from functools import reduce
 
 
 class Search(RequestHandler):
-    """Search orders:
-    - identifier (exact)
-    - tags (exact)
-    - title (words),
+    """Search orders using the in-process index of:
+    - IUID and identifier
+    - tags
+    - title words
     - fields defined in settings
+    Words must all match, unless separated by 'OR'. A word matches
+    a term beginning with it; an exact match ranks higher.
+    Only the orders for the displayed page are fetched.
     """
 
-    # Keep this in sync with JS script 'designs/order/views/keyword.js'
-    LINT = set(['an', 'to', 'in', 'on', 'of', 'and', 'the', 'was', 'not'])
-
     @tornado.web.authenticated
-    def get(self):
-        orig = term = self.get_argument('term', '')
-        orders = {}
-        parts = term.split()
-        parts = [p for p in parts if p]
-        parts.extend([p.upper() for p in parts])
-        # Try order IUIDs
-        for iuid in parts:
-            try:
-                order = self.get_entity(iuid, doctype=constants.ORDER)
-            except tornado.web.HTTPError as err:
-                pass
-            else:
-                orders[order.get('identifier') or iuid] = order
-        # Search order identifier; exact match
-        view = self.db.view('order/identifier')
-        id_sets = []
-        for part in parts:
-            id_sets.append(set([r.id for r in view[part]]))
-        if id_sets:
-            for id in reduce(lambda i,j: i.union(j), id_sets):
-                orders[id] = self.get_entity(id, doctype=constants.ORDER)
-        # Seach order tags; exact match
-        term = ''.join([c in ",;'" and ' ' or c for c in orig]).strip().lower()
-        parts = term.split()
-        view = self.db.view('order/tag')
-        id_sets = []
-        for part in parts:
-            id_sets.append(set([r.id for r in view[part]]))
-        if id_sets:
-            for id in reduce(lambda i,j: i.union(j), id_sets):
-                orders[id] = self.get_entity(id, doctype=constants.ORDER)
-        # Keep this in sync with JS script 'designs/order/views/keyword.js'
-        term = ''.join([c in ":,;'" and ' ' or c for c in orig]).strip().lower()
-        parts = [part for part in term.split()
-                 if part and len(part) >= 2 and part not in self.LINT]
-        # Search order titles for the parts extracted from search term.
-        view = self.db.view('order/keyword')
-        id_sets = []
-        for part in parts:
-            id_sets.append(set([r.id for r in
-                                view[part : part+constants.CEILING]]))
-        if id_sets:
-            # All words must exist in title
-            id_set = reduce(lambda i,j: i.intersection(j), id_sets)
-            for id in reduce(lambda i,j: i.intersection(j), id_sets):
-                orders[id] = self.get_entity(id, doctype=constants.ORDER)
-        # Search settings-defined indexes for order fields.
-        parts.append(orig)      # Entire original term.
+    async def get(self):
+        term = self.get_argument('term', '')
         try:
-            fields = list(self.db['_design/fields']['views'].keys())
-        except (couchdb.ResourceNotFound, KeyError):
-            fields = []
-        for field in fields:
-            view = self.db.view("fields/{0}".format(field))
-            id_sets = []
-            id_sets.append(set([r.id for r in
-                                view[orig : orig+constants.CEILING]]))
-            if id_sets:
-                for id in reduce(lambda i,j: i.union(j), id_sets):
-                    orders[id] = self.get_entity(id, doctype=constants.ORDER)
-        # Convert to list; keep orders readable by the user.
-        if self.is_admin():
-            orders = list(orders.values())
-        else:
-            orders = [i for i in list(orders.values())
-                      if self.is_owner(i) or self.is_colleague(i['owner'])]
+            offset = max(int(self.get_argument('offset', 0)), 0)
+        except ValueError:
+            offset = 0
+        hits = await searchindex.search(term)
+        # Keep orders readable by the user.
+        if not self.is_admin():
+            readable = set(self.get_current_colleagues())
+            readable.add(self.current_user['email'])
+            hits = [h for h in hits if h[2] in readable]
         # Go directly to order if exactly one found.
-        if len(orders) == 1:
-            self.see_other('entity', orders[0]['_id'])
-        else:
-            account_names = self.get_account_names()
-            self.render('search.html',
-                        term=orig,
-                        orders=orders,
-                        account_names=account_names)
+        if len(hits) == 1:
+            self.see_other('entity', hits[0][0])
+            return
+        limit = settings['DISPLAY_DEFAULT_PAGE_SIZE']
+        orders = await self.get_order_summaries([h[0] for h in
+                                                 hits[offset:offset+limit]])
+        account_names = self.get_account_names(
+            set([o['owner'] for o in orders]))
+        self.render('search.html',
+                    term=term,
+                    orders=orders,
+                    account_names=account_names,
+                    count=len(hits),
+                    offset=offset,
+                    limit=limit)
@@ -0,0 +1,271 @@
+"""In-process inverted index for searching orders.
+It is loaded from the database in a background thread at startup,
+and is kept current by the changes feed."""
+
+import array
+import bisect
+import logging
+import time
+
+import couchdb
+import tornado.ioloop
+
+from . import cache
+from . import constants
+from . import settings
+from . import utils
+
+# Number of orders fetched at a time when loading the index.
+LOAD_BATCH_SIZE = 1000
+
+# Relative weight of a match, according to the source of the term.
+IUID_WEIGHT       = 8
+IDENTIFIER_WEIGHT = 8
+TAG_WEIGHT        = 4
+TITLE_WEIGHT      = 2
+FIELD_WEIGHT      = 1
+
+# A prefix match has this fraction of the weight of an exact match.
+PREFIX_FACTOR = 0.5
+
+
+def get_words(value, min_length=2):
+    """Return the words of the string value, lowercased and cleaned
+    from delimiters, excluding too short words and lint."""
+    for delim in settings['ORDERS_SEARCH_DELIMS_LINT']:
+        value = value.replace(delim, ' ')
+    lint = settings['ORDERS_SEARCH_LINT']
+    return [w for w in value.lower().split()
+            if len(w) >= min_length and w not in lint]
+
+def get_terms(doc):
+    "Return a dictionary of the terms for the order, with their weights."
+    terms = {}
+    def add(term, weight):
+        if weight > terms.get(term, 0):
+            terms[term] = weight
+    add(doc['_id'], IUID_WEIGHT)
+    if doc.get('identifier'):
+        add(doc['identifier'].lower(), IDENTIFIER_WEIGHT)
+    for tag in doc.get('tags') or []:
+        add(tag.lower(), TAG_WEIGHT)
+        parts = tag.split(':')
+        if len(parts) == 2:
+            add(parts[1].lower(), TAG_WEIGHT)
+    for word in get_words(doc.get('title') or ''):
+        add(word, TITLE_WEIGHT)
+    fields = doc.get('fields') or {}
+    for identifier in settings['ORDERS_SEARCH_FIELDS']:
+        value = fields.get(identifier)
+        if not value: continue
+        if isinstance(value, str):
+            words = get_words(value, min_length=3)
+        elif isinstance(value, (int, float)):
+            words = [str(value)]
+        elif isinstance(value, list):
+            words = [str(v).lower() for v in value if v]
+        else:
+            continue
+        for word in words:
+            add(word, FIELD_WEIGHT)
+    return terms
+
+def parse_query(query):
+    """Return the query as a list of alternatives, each of which is
+    a list of words that all must match. The words of an alternative
+    are separated by 'OR' (upper case) from the words of the next."""
+    result = [[]]
+    for word in query.split():
+        if word == 'OR':
+            if result[-1]:
+                result.append([])
+        elif word != 'AND':
+            result[-1].extend(get_words(word))
+    return [words for words in result if words]
+
+
+class SearchIndex(object):
+    """Inverted index of orders. Each term has a posting list of the
+    sorted numbers of the orders containing it. The number of an order
+    is its position in the list of orders."""
+
+    def __init__(self):
+        self.numbers = {}       # Number of order, keyed by IUID.
+        self.orders = []        # Tuple (IUID, modified, owner) or None.
+        self.order_terms = []   # Terms with weights for order, or None.
+        self.postings = {}      # Array of order numbers, keyed by term.
+        self.terms = []         # Sorted list of all terms.
+        self.loaded = False
+
+    def load(self, db):
+        """Load all orders from the database.
+        The sorted list of terms is created once at the end."""
+        timer = time.time()
+        for row in db.iterview('order/modified', LOAD_BATCH_SIZE,
+                               include_docs=True):
+            self.add(row.doc, sort=False)
+        self.terms = sorted(self.postings)
+        self.loaded = True
+        logging.info("search index loaded %s orders, %s terms in %.2f s",
+                     len(self.numbers), len(self.terms), time.time() - timer)
+
+    def add(self, doc, sort=True):
+        """Add the order to the index, replacing any previous version.
+        If 'sort' is False, then the list of terms is not updated."""
+        try:
+            number = self.numbers[doc['_id']]
+        except KeyError:
+            number = len(self.orders)
+            self.numbers[doc['_id']] = number
+            self.orders.append(None)
+            self.order_terms.append(None)
+        else:
+            self.remove_terms(number)
+        self.orders[number] = (doc['_id'], doc['modified'], doc['owner'])
+        terms = get_terms(doc)
+        self.order_terms[number] = terms
+        for term in terms:
+            try:
+                posting = self.postings[term]
+            except KeyError:
+                posting = self.postings[term] = array.array('I')
+                if sort:
+                    bisect.insort(self.terms, term)
+            bisect.insort(posting, number)
+
+    def remove(self, iuid):
+        "Remove the order from the index, if present."
+        try:
+            number = self.numbers.pop(iuid)
+        except KeyError:
+            return
+        self.remove_terms(number)
+        self.orders[number] = None
+
+    def remove_terms(self, number):
+        "Remove the order given by number from the posting lists."
+        for term in self.order_terms[number] or []:
+            posting = self.postings[term]
+            pos = bisect.bisect_left(posting, number)
+            if pos < len(posting) and posting[pos] == number:
+                del posting[pos]
+            if not posting:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+        self.order_terms[number] = None
+
+    def match(self, word):
+        """Return the score for each order number having a term which
+        equals or begins with the word. The best matching term counts."""
+        result = {}
+        pos = bisect.bisect_left(self.terms, word)
+        while pos < len(self.terms) and self.terms[pos].startswith(word):
+            term = self.terms[pos]
+            factor = term == word and 1.0 or PREFIX_FACTOR
+            for number in self.postings[term]:
+                score = self.order_terms[number][term] * factor
+                if score > result.get(number, 0):
+                    result[number] = score
+            pos += 1
+        return result
+
+    def search(self, query):
+        """Return the list of tuples (IUID, modified, owner) for the orders
+        matching the query, the best first, then the most recently modified.
+        See 'parse_query' for the query syntax."""
+        scores = {}
+        for words in parse_query(query):
+            found = None
+            for word in words:
+                matches = self.match(word)
+                if found is None:
+                    found = matches
+                else:
+                    found = dict([(n, s + matches[n])
+                                  for n, s in found.items() if n in matches])
+                if not found: break
+            for number, score in (found or {}).items():
+                if score > scores.get(number, 0):
+                    scores[number] = score
+        numbers = sorted(scores,
+                         key=lambda n: (scores[n], self.orders[n][1]),
+                         reverse=True)
+        return [self.orders[n] for n in numbers]
+
+
+_index = SearchIndex()
+# The future of the load in progress, if any.
+_loading = None
+# The changes made while loading; tuples (IUID, doc), where doc is None
+# for a deleted order. They are applied when the load has finished.
+_pending = []
+
+async def load():
+    """Load the index in a background thread, unless done already.
+    The thread uses a database handle of its own, since the handle of
+    the process is not thread-safe."""
+    global _loading
+    if _index.loaded: return
+    if _loading is None:
+        _loading = tornado.ioloop.IOLoop.current().run_in_executor(
+            None, _load, SearchIndex(), utils.create_db())
+    try:
+        index = await _loading
+    except (couchdb.http.HTTPError, IOError) as msg:
+        logging.error("could not load the search index: %s", msg)
+        _loading = None
+        _pending[:] = []
+        raise
+    if not _index.loaded:
+        _set_index(index)
+
+def _load(index, db):
+    index.load(db)
+    return index
+
+def _set_index(index):
+    "Use the loaded index, after applying the changes made meanwhile."
+    global _index, _loading
+    for iuid, doc in _pending:
+        if doc is None:
+            index.remove(iuid)
+            continue
+        # The order may have been loaded in a later version.
+        try:
+            number = index.numbers[iuid]
+            if index.orders[number][1] > doc['modified']: continue
+        except KeyError:
+            pass
+        index.add(doc)
+    _pending[:] = []
+    _index = index
+    _loading = None
+
+async def search(query):
+    """Search the orders; see 'SearchIndex.search'.
+    Wait for the index to be loaded, if not done already."""
+    if not _index.loaded:
+        await load()
+    return _index.search(query)
+
+def update_order(doc):
+    "Update the index for the order just saved, if the index is loaded."
+    if _index.loaded:
+        _index.add(doc)
+    elif _loading is not None:
+        _pending.append((doc['_id'], doc))
+
+def remove_order(iuid):
+    "Remove the order just deleted from the index, if the index is loaded."
+    if _index.loaded:
+        _index.remove(iuid)
+    elif _loading is not None:
+        _pending.append((iuid, None))
+
+def _search_index_listener(row):
+    if row.get('deleted'):
+        remove_order(row['id'])
+    elif row['doc'].get(constants.DOCTYPE) == constants.ORDER:
+        update_order(row['doc'])
+
+cache.add_change_listener(_search_index_listener)
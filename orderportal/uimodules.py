@@ -2,10 +2,10 @@
 
 
 
-import markdown
 import tornado.web
 from tornado.escape import xhtml_escape as escape
 
+from . import cache
 from . import constants
 from . import settings
 from . import utils
@@ -112,21 +112,20 @@ class Markdown(tornado.web.UIModule):
         text = text or ''
         if not safe:
             text = escape(text)
-        return markdown.markdown(text, output_format='html5')
+        return cache.get_markdown_html(text)
 
 
 class Text(tornado.web.UIModule):
     "Fetch text object from the database, process it, and output."
 
     def render(self, name, default=''):
-        try:
-            doc = self.handler.get_entity_view('text/name', name)
-            text = doc['text']
-        except (tornado.web.HTTPError, KeyError):
-            text = default
+        html = cache.get_text_html(self.handler.db, name)
+        if html is not None:
+            return html
+        text = default
         if not text and self.handler.is_admin():
             text = "<i>No text defined.</i>"
-        return markdown.markdown(text, output_format='html5')
+        return cache.get_markdown_html(text)
 
 
 class Tags(tornado.web.UIModule):
@@ -1,5 +1,6 @@
 "Various utility functions."
 
+import atexit
 import collections
 import csv
 import datetime
@@ -9,7 +10,9 @@ import logging
 import mimetypes
 import optparse
 import os
+import random
 import sys
+import tempfile
 import time
 import traceback
 import urllib.request, urllib.parse, urllib.error
@@ -17,6 +20,7 @@ import urllib.parse
 import uuid
 
 import couchdb
+import tornado.gen
 import tornado.web
 import xlsxwriter
 import yaml
@@ -201,22 +205,171 @@ def expand_filepath(filepath):
         filepath = os.path.join(settings['ROOT_DIR'], filepath)
     return filepath
 
+class ConnectionPool(couchdb.http.ConnectionPool):
+    """Pool of keep-alive HTTP connections to the CouchDB server.
+    At most 'size' idle connections are kept per host; any surplus
+    connection is closed when released. Usage statistics are recorded.
+    """
+
+    def __init__(self, timeout, size):
+        super(ConnectionPool, self).__init__(timeout)
+        self.size = size
+        self.stats = dict(created=0, reused=0, released=0, discarded=0)
+
+    def get(self, url):
+        key = couchdb.util.urlsplit(url, 'http', False)[:2]
+        if self.conns.get(key):
+            self.stats['reused'] += 1
+        else:
+            self.stats['created'] += 1
+        return super(ConnectionPool, self).get(url)
+
+    def release(self, url, conn):
+        key = couchdb.util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            idle = self.conns.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                self.stats['released'] += 1
+                return
+        conn.close()
+        self.stats['discarded'] += 1
+
+    def get_stats(self):
+        "Return a dictionary of the usage statistics."
+        result = self.stats.copy()
+        result['size'] = self.size
+        result['idle'] = sum([len(c) for c in self.conns.values()])
+        return result
+
+# The process-wide CouchDB server and database handles.
+# They share one session, and thereby one connection pool.
+_dbserver = None
+_db = None
+
 def get_dbserver():
-    server = couchdb.Server(settings['DATABASE_SERVER'])
-    if settings.get('DATABASE_ACCOUNT') and settings.get('DATABASE_PASSWORD'):
+    "Return the CouchDB server handle, which uses the connection pool."
+    global _dbserver
+    if _dbserver is None:
+        _dbserver = create_dbserver(
+            connection_pool=ConnectionPool(settings['DATABASE_TIMEOUT'],
+                                           settings['DATABASE_POOL_SIZE']))
+    return _dbserver
+
+def create_dbserver(connection_pool=None):
+    """Return a new CouchDB server handle with a session of its own,
+    using the given connection pool, if any, else the default one."""
+    session = couchdb.http.Session(timeout=settings['DATABASE_TIMEOUT'])
+    if connection_pool is not None:
+        session.connection_pool = connection_pool
+    server = couchdb.Server(settings['DATABASE_SERVER'], session=session)
+    if settings.get('DATABASE_ACCOUNT') and \
+       settings.get('DATABASE_PASSWORD'):
         server.resource.credentials = (settings.get('DATABASE_ACCOUNT'),
                                        settings.get('DATABASE_PASSWORD'))
     return server
 
 def get_db():
     "Return the handle for the CouchDB database."
-    server = get_dbserver()
+    global _db
+    if _db is None:
+        _db = get_server_db(get_dbserver())
+    return _db
+
+def create_db():
+    """Return a new handle for the CouchDB database, with a session of its
+    own. The process-wide handle must be used only by the IOLoop thread,
+    since its session and connection pool are not thread-safe; this is
+    for use by other threads."""
+    return get_server_db(create_dbserver())
+
+def get_server_db(server):
+    "Return the handle for the CouchDB database from the server handle."
     try:
         return server[settings['DATABASE_NAME']]
     except couchdb.http.ResourceNotFound:
-        raise KeyError("CouchDB database '%s' does not exist." % 
+        raise KeyError("CouchDB database '%s' does not exist." %
                        settings['DATABASE_NAME'])
 
+def reset_process_state():
+    """Clear the state which must not be shared with the parent process
+    after a fork; the database connections, the reserved counter numbers
+    and the buffered log entries."""
+    global _dbserver, _db, _log_entries
+    _dbserver = None
+    _db = None
+    _counter_blocks.clear()
+    _log_entries = []
+
+def get_dbpool_stats():
+    "Return the usage statistics for the CouchDB connection pool."
+    return get_dbserver().resource.session.connection_pool.get_stats()
+
+# Reserved block of counter numbers for this process, keyed by doctype.
+# The value is a list [next number, last number in block].
+_counter_blocks = dict()
+# Statistics of counter number allocation, for display.
+_counter_stats = dict(numbers=0, reservations=0, conflicts=0, max_conflicts=0)
+
+async def get_next_counter(db, doctype):
+    """Get the next counter number for the doctype.
+    The numbers are reserved in blocks of COUNTER_BLOCK_SIZE
+    from the counter document, so that it is updated only once
+    per block. Numbers left in the block when the process stops
+    will not be used."""
+    try:
+        block = _counter_blocks[doctype]
+        if block[0] > block[1]: raise KeyError
+    except KeyError:
+        block = await reserve_counter_block(db, doctype,
+                                      max(settings['COUNTER_BLOCK_SIZE'], 1))
+        _counter_blocks[doctype] = block
+    number = block[0]
+    block[0] += 1
+    _counter_stats['numbers'] += 1
+    return number
+
+async def reserve_counter_block(db, doctype, size):
+    """Reserve a block of counter numbers by updating the counter document.
+    Retry after a jittered exponential backoff if another process updated
+    it concurrently; raise ValueError if the retries are exhausted.
+    The backoff does not block the IOLoop.
+    Return the list [first number, last number]."""
+    conflicts = 0
+    delay = constants.COUNTER_RETRY_DELAY
+    while True:
+        try:
+            doc = db[doctype] # Doc must be reloaded each iteration
+        except couchdb.ResourceNotFound:
+            doc = dict(_id=doctype)
+            doc[constants.DOCTYPE] = constants.META
+        first = doc.get('counter', 0) + 1
+        doc['counter'] = first + size - 1
+        try:
+            db.save(doc)
+        except couchdb.ResourceConflict:
+            conflicts += 1
+            _counter_stats['conflicts'] += 1
+            if conflicts > constants.COUNTER_RETRIES:
+                logging.warning("counter %s block not reserved after %s"
+                                " conflicts", doctype, conflicts)
+                raise ValueError('Could not update the counter; try again.')
+            await tornado.gen.sleep(random.uniform(0, delay))
+            delay = min(2 * delay, constants.COUNTER_RETRY_MAX_DELAY)
+        else:
+            break
+    _counter_stats['reservations'] += 1
+    if conflicts > _counter_stats['max_conflicts']:
+        _counter_stats['max_conflicts'] = conflicts
+    if conflicts:
+        logging.info("counter %s block reserved after %s conflicts",
+                     doctype, conflicts)
+    return [first, first + size - 1]
+
+def get_counter_stats():
+    "Return the statistics of counter number allocation."
+    return dict(_counter_stats)
+
 def initialize(db=None):
     "Load the design documents, or update."
     if db is None:
@@ -336,8 +489,45 @@ def hashed_password(password):
     sha256.update(password.encode())
     return sha256.hexdigest()
 
-def log(db, rqh, entity, changed=dict()):
-    "Add a log entry for the change of the given entity."
+# Log entries not yet written to the process-wide database handle.
+_log_entries = []
+
+def log(db, rqh, entity, changed=dict(), flush=False):
+    """Add a log entry for the change of the given entity.
+    If the database handle is the process-wide one, the entry is buffered,
+    and written when LOG_BATCH_SIZE entries have accumulated, or when the
+    buffer is flushed periodically. Else it is written directly.
+    Use 'flush' if the log is to be read directly afterwards."""
+    entry = get_log_entry(rqh, entity, changed=changed)
+    if db is not _db:
+        db.save(entry)
+        return
+    _log_entries.append(entry)
+    if flush or len(_log_entries) >= settings['LOG_BATCH_SIZE']:
+        flush_log()
+
+def flush_log():
+    """Write the buffered log entries to the database in one request.
+    On failure the entries are kept for the next attempt, up to
+    LOG_BUFFER_MAX entries; the oldest are discarded beyond that."""
+    global _log_entries
+    if not _log_entries: return
+    entries = _log_entries
+    _log_entries = []
+    try:
+        get_db().update(entries)
+    except (couchdb.http.HTTPError, IOError) as msg:
+        logging.error("could not write %s log entries: %s", len(entries), msg)
+        _log_entries = entries + _log_entries
+        excess = len(_log_entries) - constants.LOG_BUFFER_MAX
+        if excess > 0:
+            logging.warning("discarded the %s oldest log entries", excess)
+            del _log_entries[:excess]
+
+atexit.register(flush_log)
+
+def get_log_entry(rqh, entity, changed=dict()):
+    "Return a log entry document for the change of the given entity."
     entry = dict(_id=get_iuid(),
                  entity=entity['_id'],
                  entity_type=entity[constants.DOCTYPE],
@@ -356,7 +546,7 @@ def log(db, rqh, entity, changed=dict()):
         entry['account'] = rqh.current_user['email']
     except (AttributeError, TypeError, KeyError):
         pass
-    db.save(entry)
+    return entry
 
 def get_filename_extension(content_type):
     "Return filename extension, correcting for silliness in 'mimetypes'."
@@ -395,15 +585,34 @@ class CsvWriter(object):
     def getvalue(self):
         return self.csvbuffer.getvalue()
 
+    def pop(self):
+        "Return the output written since the previous pop, and clear it."
+        value = self.csvbuffer.getvalue()
+        self.csvbuffer.seek(0)
+        self.csvbuffer.truncate()
+        return value
 
-class XlsxWriter(object):
-    "Write rows serially to an XLSX file."
+    def close(self):
+        "No more rows will be written."
+        pass
 
-    def __init__(self, worksheet='Main'):
-        self.xlsxbuffer = io.BytesIO()
-        self.workbook = xlsxwriter.Workbook(self.xlsxbuffer, {'in_memory':True})
+
+class XlsxWriter(object):
+    """Write rows serially to an XLSX file.
+    If 'constant_memory', then the rows and the resulting file
+    are stored in temporary files instead of in memory."""
+
+    def __init__(self, worksheet='Main', constant_memory=False):
+        if constant_memory:
+            self.xlsxbuffer = tempfile.TemporaryFile()
+            options = {'constant_memory': True}
+        else:
+            self.xlsxbuffer = io.BytesIO()
+            options = {'in_memory': True}
+        self.workbook = xlsxwriter.Workbook(self.xlsxbuffer, options)
         self.ws = self.workbook.add_worksheet(worksheet)
         self.x = 0
+        self.closed = False
 
     def new_worksheet(self, name):
         self.ws = self.workbook.add_worksheet(name)
@@ -418,6 +627,19 @@ class XlsxWriter(object):
         self.x += 1
 
     def getvalue(self):
+        self.close()
+        self.xlsxbuffer.seek(0)
+        return self.xlsxbuffer.read()
+
+    def pop(self):
+        """Return the next chunk of the output. The file is available
+        only when closed; until then, nothing is returned."""
+        if not self.closed: return b''
+        return self.xlsxbuffer.read(constants.CHUNK_SIZE)
+
+    def close(self):
+        "Finish the file; no more rows can be written."
+        if self.closed: return
         self.workbook.close()
         self.xlsxbuffer.seek(0)
-        return self.xlsxbuffer.getvalue()
+        self.closed = True